@@ -1,4 +1,4 @@
-from .findpydeps import run, parser
+from .findpydeps import run, parser, find_source_dependencies
 
 __version__ = "0.2.6"
 __author__ = "Nicolas Reyland"
@@ -34,13 +34,26 @@ options:
 """
 
 # Python Dependencies
-from argparse import ArgumentParser
+from argparse import ArgumentParser, ArgumentTypeError
 import os
 import sys
 import fnmatch
+import platform
 import ast
-
-from typing import Iterable, AnyStr
+import dis
+import importlib.util
+import io
+import itertools
+import json
+import marshal
+import re
+import subprocess
+import time
+import tokenize
+import types
+import zlib
+
+from typing import Iterable, AnyStr, Callable
 
 # Argument Parser
 
@@ -51,7 +64,9 @@ if sys.argv[0].endswith("__main__.py"):
     renamed_sys_argv0 = True
 
 parser = ArgumentParser(
-    description="Find the python dependencies used by your python files"
+    description="Find the python dependencies used by your python files",
+    epilog='subcommands: "merge" (combine --shard partial results), "index" (persistent import index). '
+           'Try "findpydeps merge -h" or "findpydeps index -h".',
 )
 
 if renamed_sys_argv0:
@@ -159,9 +174,351 @@ parser.add_argument(
 
 parser.set_defaults(header=True)
 
+
+def shard_spec(value: str) -> tuple[int, int]:
+    """Parse a shard specification of the form "I/N" (1 <= I <= N)"""
+
+    index, sep, count = value.partition("/")
+    try:
+        if not sep:
+            raise ValueError
+        index, count = int(index), int(count)
+    except ValueError:
+        raise ArgumentTypeError(f'invalid shard "{value}" (expected I/N, e.g. 1/4)')
+    if count < 1 or not 1 <= index <= count:
+        raise ArgumentTypeError(f'invalid shard "{value}" (expected 1 <= I <= N)')
+    return index, count
+
+
+parser.add_argument(
+    "--shard",
+    metavar="I/N",
+    type=shard_spec,
+    help="only scan the I-th of N deterministic partitions of the input files and write a partial "
+         "result (no removal policy applied) for \"findpydeps merge\"",
+)
+
+parser.add_argument(
+    "--shard-output",
+    metavar="file",
+    type=str,
+    default="-",
+    help="file in which the --shard partial result is written [default: stdout]",
+)
+
+
+def size_spec(value: str) -> int:
+    """Parse a size in bytes, with an optional k/M/G suffix (e.g. "512k", "2M")"""
+
+    match = re.fullmatch(r"\s*(\d+)\s*([kKmMgG]?)[bB]?\s*", value)
+    if not match:
+        raise ArgumentTypeError(f'invalid size "{value}" (e.g. 500000, 512k, 2M)')
+    return int(match.group(1)) * 1024 ** " KMG".index(match.group(2).upper() or " ")
+
+
+parser.add_argument(
+    "--max-file-size",
+    metavar="size",
+    type=size_spec,
+    help="files bigger than this size (e.g. 512k, 2M) are not parsed, but handled by the --over-budget action",
+)
+
+parser.add_argument(
+    "--max-file-time",
+    metavar="seconds",
+    type=float,
+    help="files whose import search takes longer than this are handled by the --over-budget action (the files "
+         "whose parsing takes longer are only reported in the --stats)",
+)
+
+parser.add_argument(
+    "--detect-generated",
+    action="store_true",
+    help="handle generated files (protobuf, 'DO NOT EDIT' headers, ...) by the --over-budget action",
+)
+
+parser.add_argument(
+    "--over-budget",
+    metavar="action",
+    choices=["scan", "skip"],
+    default="scan",
+    help="what to do with files over a budget (scan: cheap line-based import scan, skip: ignore the file) "
+         "[default: %(default)s]",
+)
+
+parser.add_argument(
+    "--stats",
+    action="store_true",
+    help="print statistics about the scan on stderr (including the files over a budget)",
+)
+
+parser.add_argument(
+    "--check-installed",
+    action="store_true",
+    help="report the dependencies which cannot be imported in the current environment (exit status 1 if any)",
+)
+
+parser.add_argument(
+    "--bytecode",
+    action="store_true",
+    help="read the imports from the up-to-date __pycache__ bytecode of the files instead of parsing their source "
+         "(ignored with --no-blocks)",
+)
+
+parser.add_argument(
+    "--header-only",
+    action="store_true",
+    help="only scan the module preamble of the files (imports, docstrings and 'try'/'if' import guards, whose "
+         "blocks only hold imports), the rest of the files is never read",
+)
+
+parser.add_argument(
+    "--affected-by",
+    metavar="file",
+    type=str,
+    nargs="+",
+    help="print the input files which (transitively) import any of these files, instead of the dependencies "
+         "(e.g. to only run the affected tests)",
+)
+
+parser.add_argument(
+    "--stdin",
+    action="store_true",
+    help="also read python source code from stdin (e.g. an editor buffer)",
+)
+
+parser.add_argument(
+    "--stdin-path",
+    metavar="path",
+    type=str,
+    default="<stdin>",
+    help="virtual path of the --stdin source code, used to resolve its local imports [default: %(default)s, in the "
+         "working directory]",
+)
+
+parser.add_argument(
+    "--git-rev",
+    metavar="rev",
+    type=str,
+    action="append",
+    help="scan the files of this revision of the local git repository, without checking it out (the inputs "
+         "default to the working directory). Given twice, print the dependencies removed (-) and added (+) "
+         "between the two revisions",
+)
+
+parser.add_argument(
+    "--progress",
+    dest="progress",
+    action="store_true",
+    help="show the progress of the scan on stderr [default: only if stderr is a terminal]",
+)
+
+parser.add_argument(
+    "--no-progress",
+    dest="progress",
+    action="store_false",
+    help="don't show the progress of the scan",
+)
+
+parser.set_defaults(progress=None)
+
+parser.add_argument(
+    "--files-from",
+    metavar="path",
+    type=str,
+    help="read the input files from this NUL- or newline-delimited list (\"-\" for stdin, e.g. "
+         "\"git ls-files -z | findpydeps --files-from -\"), without scanning directories. "
+         "Only the files matching --dir-scanning-expr are kept",
+)
+
+parser.add_argument(
+    "--transitive",
+    action="store_true",
+    help="print the installed distributions of the dependencies and all their requirements (Requires-Dist of the "
+         "local environment), instead of the module names",
+)
+
+parser.add_argument(
+    "--import-cost",
+    action="store_true",
+    help="measure the import time of each dependency in the current environment (python -X importtime, in "
+         "isolated subprocesses) and print them, the heaviest first",
+)
+
+parser.add_argument(
+    "--import-cost-workers",
+    metavar="n",
+    type=int,
+    default=os.cpu_count() or 1,
+    help="number of --import-cost subprocesses running at the same time [default: number of CPUs]",
+)
+
+parser.add_argument(
+    "--audit-lazy",
+    action="store_true",
+    help="report the top-level imports whose names are only used inside functions (their import could be "
+         "deferred into those functions to speed up the start-up)",
+)
+
+parser.add_argument(
+    "--rollup",
+    metavar="depth",
+    type=int,
+    help="print the dependencies of each directory of the inputs, down to this depth (the files of deeper "
+         "directories are counted in their ancestor at this depth, and each directory includes its subdirectories)",
+)
+
+
+def module_names_spec(value: str) -> set[str]:
+    """Parse a comma-separated list of module names (e.g. "pickle,telnetlib")"""
+
+    names = {name.strip() for name in value.split(",")} - {""}
+    if not names:
+        raise ArgumentTypeError(f'invalid module names "{value}" (e.g. pickle,telnetlib)')
+    return names
+
+
+parser.add_argument(
+    "--contains",
+    metavar="name[,name...]",
+    type=module_names_spec,
+    help="stop as soon as one of these modules (or one of their submodules) is found, whatever the removal "
+         "policy, and print the file importing it. The exit status is 0 if it was found, 1 otherwise",
+)
+
+parser.add_argument(
+    "--contains-all",
+    action="store_true",
+    help="with --contains, only stop once all the modules are found",
+)
+
+merge_parser = ArgumentParser(
+    prog=f"{parser.prog} merge",
+    description="Merge the partial results of --shard scans into the final dependencies",
+)
+
+merge_parser.add_argument(
+    "partials",
+    metavar="partial",
+    type=str,
+    nargs="+",
+    help='partial result files written by "--shard I/N" ("-" for stdin)',
+)
+
+merge_parser.add_argument(
+    "-r",
+    "--removal-policy",
+    metavar="policy",
+    type=int,
+    default=0,
+    help="removal policy for modules (0: local & stdlib, 1: local only, 2: stdlib only, 3: no removal) [default: %("
+         "default)s]",
+)
+
+merge_parser.add_argument(
+    "--header", dest="header", action="store_true", help="show the greeting header"
+)
+
+merge_parser.add_argument(
+    "--no-header",
+    dest="header",
+    action="store_false",
+    help="don't show the greeting header",
+)
+
+merge_parser.set_defaults(header=True)
+
+index_parser = ArgumentParser(
+    prog=f"{parser.prog} index",
+    description="Update a persistent (SQLite) import index of your python files, or query it without re-parsing "
+                "any file",
+)
+
+index_parser.add_argument(
+    "--db",
+    metavar="path",
+    type=str,
+    default=".findpydeps.db",
+    help="path of the index database [default: %(default)s]",
+)
+
+index_parser.add_argument(
+    "-i",
+    "--input",
+    metavar="input",
+    type=str,
+    nargs="+",
+    help="input files and/or directories to (re-)index, only the modified files are parsed again",
+)
+
+index_parser.add_argument(
+    "-d",
+    "--dir-scanning-expr",
+    metavar="expr",
+    type=str,
+    default="*.py",
+    help="only index files with this expression in scanned directories [default: %(default)s]",
+)
+
+index_parser.add_argument(
+    "--no-blocks",
+    dest="blocks",
+    action="store_false",
+    help="don't scan contents of 'if', 'try' and 'with' blocks",
+)
+
+index_parser.add_argument(
+    "--no-functions",
+    dest="functions",
+    action="store_false",
+    help="don't scan contents of functions",
+)
+
+index_parser.add_argument(
+    "--submodules-as-modules",
+    dest="submodules",
+    action="store_true",
+    help="submodule imports are treated as module-imports",
+)
+
+index_parser.add_argument(
+    "-v",
+    "--verbose",
+    action="store_true",
+    help="verbose mode (all messages prepended with '#')",
+)
+
+index_queries = index_parser.add_subparsers(dest="query", metavar="query", required=False)
+
+who_imports_parser = index_queries.add_parser(
+    "who-imports",
+    help="list the files which import any of the given modules (submodules included)",
+)
+
+who_imports_parser.add_argument("modules", metavar="module", type=str, nargs="+", help="module names")
+
+deps_parser = index_queries.add_parser(
+    "deps",
+    help="list the dependencies of the indexed files in the given directories and/or files",
+)
+
+deps_parser.add_argument("paths", metavar="path", type=str, nargs="+", help="directories and/or files")
+
+deps_parser.add_argument(
+    "-r",
+    "--removal-policy",
+    metavar="policy",
+    type=int,
+    default=0,
+    help="removal policy for modules (0: local & stdlib, 1: local only, 2: stdlib only, 3: no removal) [default: %("
+         "default)s]",
+)
+
 # Constants
 HEADER: str = "# Generated by https://github.com/Nicolas-Reyland/findpydeps"
 USAGE_MSG: str = 'Try "python3 -m findpydeps -h" to get help.'
+PARTIAL_FORMAT: str = "findpydeps-partial"
+PARTIAL_VERSION: int = 1
 
 PYTHON_STANDARD_MODULES: frozenset[str] = getattr(sys, "stdlib_module_names", frozenset({
     "__future__",
@@ -376,9 +733,105 @@ PYTHON_STANDARD_MODULES: frozenset[str] = getattr(sys, "stdlib_module_names", fr
     "zoneinfo",
 }))
 
+# markers found in the first bytes of generated python files
+GENERATED_FILE_MARKERS: tuple[str, ...] = (
+    "@generated",
+    "DO NOT EDIT",
+    "Generated by the protocol buffer compiler",
+    "Code generated by",
+    "autogenerated",
+    "auto-generated",
+)
+GENERATED_HEADER_SIZE: int = 2048
+
+# first keywords of the top-level statements of a module preamble (see `parse_module_header`)
+HEADER_STATEMENT_KEYWORDS: frozenset[str] = frozenset({
+    "import", "from", "try", "except", "else", "finally", "if", "elif",
+})
+# first keywords of the statements allowed in the blocks of an import guard (and 'name = ...' fallbacks)
+GUARD_STATEMENT_KEYWORDS: frozenset[str] = HEADER_STATEMENT_KEYWORDS | {"pass", "raise"}
+COMPOUND_STATEMENT_KEYWORDS: frozenset[str] = HEADER_STATEMENT_KEYWORDS - {"import", "from"}
+
+# cheap (line-based) import scan, used for the files over a budget
+CHEAP_IMPORT_REGEX: re.Pattern = re.compile(
+    r"^[ \t]*(?:from[ \t]+(\.*[\w.]*)[ \t]+import[ \t]+(\([^)]*\)|[^\n#;]*)|import[ \t]+([^\n#;]*))",
+    re.MULTILINE,
+)
+
+# index of the top-level importable names of each sys.path entry (see `installed_top_level_names`)
+SYS_PATH_INDEX_FILE: str = "sys-path-index.json"
+EXTENSION_MODULE_SUFFIXES: tuple[str, ...] = (".py", ".pyc", ".pyw", ".so", ".pyd")
+
+# code object flags (see the "inspect" module) used to tell functions apart in bytecode
+CO_OPTIMIZED: int = 0x0001
+CO_COROUTINE: int = 0x0080
+CO_ASYNC_GENERATOR: int = 0x0200
+
+# tables of the persistent import index (see `open_index`)
+INDEX_SCHEMA: str = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER);
+CREATE TABLE IF NOT EXISTS imports (path TEXT, module TEXT, PRIMARY KEY (path, module));
+CREATE INDEX IF NOT EXISTS imports_module ON imports (module);
+CREATE TABLE IF NOT EXISTS local_edges (path TEXT, target TEXT, PRIMARY KEY (path, target));
+CREATE INDEX IF NOT EXISTS local_edges_target ON local_edges (target);
+CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, mtime_ns INTEGER, listing INTEGER);
+CREATE TABLE IF NOT EXISTS file_dirs (path TEXT, dir TEXT, PRIMARY KEY (path, dir));
+CREATE INDEX IF NOT EXISTS file_dirs_dir ON file_dirs (dir);
+"""
+INDEX_VERSION: int = 2
+# directories looked at to tell the local imports of the file being indexed apart (see `update_index`)
+CONSULTED_DIRS: set[str] | None = None
+
+# files of the scanned git revision (see `open_git_revision`), None when scanning the filesystem
+GIT_FILES: dict[str, str] | None = None
+GIT_DIRS: dict[str, list[str]] = dict()
+GIT_CAT_FILE: subprocess.Popen | None = None
+
+# installed distributions of each sys.path entry (see `installed_distributions`)
+DISTRIBUTIONS_INDEX_FILE: str = "distributions-index.json"
+REQUIREMENT_REGEX: re.Pattern = re.compile(
+    r"\s*([A-Za-z0-9][A-Za-z0-9._-]*)\s*(?:\[([^\]]*)\])?[^;]*(?:;\s*(.*))?"
+)
+MARKER_TOKEN_REGEX: re.Pattern = re.compile(
+    r"\s*(\"[^\"]*\"|'[^']*'|===|==|!=|<=|>=|~=|<|>|\(|\)|not\s+in\b|[A-Za-z_][A-Za-z0-9_.]*)"
+)
+
+# import costs of the dependencies (see `import_costs`)
+IMPORT_COST_FILE: str = "import-cost.json"
+IMPORT_COST_TIMEOUT: float = 120.0
+
 DEPENDENCIES: set[str] = set()
+DIR_INDEX: dict[str, tuple[int, list[str]]] = dict()
+DEFAULT_ARGS: dict[str, bool | AnyStr | Iterable[AnyStr]] | None = None
+LOCAL_DEPENDENCIES: set[str] = set()
 READ_FILES: set[str] = set()
 
+# scan statistics (see `print_stats`)
+STATS: dict[str, float] = {
+    "files_parsed": 0,
+    "files_scanned": 0,
+    "files_from_bytecode": 0,
+    "files_skipped": 0,
+    "bytes_read": 0,
+    "bytes_skipped": 0,
+    "parse_time": 0.0,
+    "search_time": 0.0,
+}
+OVER_BUDGET_FILES: list[tuple[str, str]] = list()
+FILE_LIST_CHUNK_SIZE: int = 1 << 16
+
+# progress of the current phase of the scan (see `start_progress`), None when not shown
+SHOW_PROGRESS: bool = False
+PROGRESS: dict[str, float | str | None] | None = None
+PROGRESS_REFRESH_INTERVAL: float = 0.25
+WALK_DEADLINE: float | None = None
+
+# names bound by the top-level imports of the file being searched, and where they are used (see `search_ast_imports`)
+LAZY_AUDIT: dict[str, dict | set[str]] | None = None
+LAZY_IMPORTS: list[tuple[str, int, str, str]] = list()
+FUNCTION_NODE_TYPES: tuple[type, ...] = (ast.FunctionDef, ast.AsyncFunctionDef, ast.Lambda)
+
 ROOT_DIR: str = os.path.dirname(os.path.abspath(__file__))
 
 
@@ -416,6 +869,10 @@ class ArgumentError(Exception):
         )
 
 
+class BudgetExceeded(Exception):
+    """Raised when the import search of a file exceeds its time budget (--max-file-time)"""
+
+
 # Functions
 def path_from_relative_import(base_path: str, import_str: str) -> tuple[bool, str]:
     """Builds the path corresponding to a python relative import string
@@ -588,13 +1045,13 @@ def get_module_names_in_import_from_obj(
     #  - check if any of the files in this directory are in this format: /(filename)(.py[^\.]*)/
     if (
             not must_be_dir
-            and os.path.isdir(potential_path_dirname)
+            and path_is_dir(potential_path_dirname)
             and any(os.path.basename(fn).partition(".py")[0] == potential_path_filename for fn in
                     files_in_dir(potential_path_dirname) if ".py" in fn)
     ):
         vprint(f"import refers to a file: {potential_path_filename}")
         return set(), {potential_path}
-    if os.path.isdir(potential_path):
+    if path_is_dir(potential_path):
         vprint(f"import refers to a directory: {potential_path}")
 
         if len(obj.names) == 1 and obj.names[0].name == "*":
@@ -671,7 +1128,7 @@ def modules_from_ast_import_object(
             # check for local import
             file_path = path_from_relative_import(current_path, import_name)[1]
             file_path_dir = os.path.dirname(file_path)
-            if (os.path.isfile(file_path + ".py") or os.path.isdir(file_path_dir) and any(
+            if (path_is_file(file_path + ".py") or path_is_dir(file_path_dir) and any(
                     os.path.basename(fn).partition(".py")[0] == import_name for fn in files_in_dir(file_path_dir) if
                     ".py" in fn)):
                 # simple local import
@@ -686,7 +1143,7 @@ def modules_from_ast_import_object(
 
 
 def handle_ast_object(
-        obj: ast.AST, ast_path: str, args: dict[str, bool]
+        obj: ast.AST, ast_path: str, args: dict[str, bool], in_function: bool = False
 ) -> tuple[set[str], set[str]]:
     """Go through an abstract ast.AST (derived or not) objects
 
@@ -703,6 +1160,9 @@ def handle_ast_object(
         Path of the python source code file described by the AST
     args : dict[str, bool]
         The command-line arguments given to this script
+    in_function : bool
+        The object is only executed when a function is called (used by the --audit-lazy
+        bookkeeping, see `LAZY_AUDIT`)
 
     Returns
     -------
@@ -718,27 +1178,54 @@ def handle_ast_object(
     ------
     AssertionError
         The `obj` is not derived from the ast.AST abstract class
+    BudgetExceeded
+        The time budget of the file (`WALK_DEADLINE`) is exceeded
 
     """
 
     t = type(obj)
     assert issubclass(t, ast.AST)
 
-    if not args["blocks"] and t in [ast.If, ast.With, ast.Try]:
+    if WALK_DEADLINE is not None and time.perf_counter() > WALK_DEADLINE:
+        raise BudgetExceeded
+
+    # a name used somewhere (only looked at by the --audit-lazy bookkeeping)
+    if t is ast.Name:
+        if LAZY_AUDIT is not None and type(obj.ctx) is ast.Load:
+            LAZY_AUDIT["function_uses" if in_function else "module_uses"].add(obj.id)
         return set(), set()
-    if not args["functions"] and t is ast.FunctionDef:
+
+    if (not args["blocks"] and t in [ast.If, ast.With, ast.Try]) or (
+            not args["functions"] and t is ast.FunctionDef
+    ):
+        # no imports searched in there, but the names still count as used
+        if LAZY_AUDIT is not None:
+            audit_name_uses(obj, in_function)
         return set(), set()
 
     # is the current ast object an import ?
     if t is ast.Import or t is ast.ImportFrom:
         # declare 'obj' of being of one of those two types
         obj: ast.Import | ast.ImportFrom
+        if LAZY_AUDIT is not None and not in_function:
+            audit_import_bindings(obj)
         global_deps, local_deps_files = modules_from_ast_import_object(
             obj, ast_path, args
         )
         vprint(f"global: {global_deps}, local files: {local_deps_files}")
         return global_deps, local_deps_files
 
+    # the lazy-import audit needs every node, not only the lists of statements
+    if LAZY_AUDIT is not None:
+        global_deps, local_deps_files = set(), set()
+        for sub_in_function, sub_obj in audit_children(obj, in_function):
+            sub_global_deps, sub_local_deps_files = handle_ast_object(
+                sub_obj, ast_path, args, sub_in_function
+            )
+            global_deps |= sub_global_deps
+            local_deps_files |= sub_local_deps_files
+        return global_deps, local_deps_files
+
     # try to iterate through python object properties that could,
     # somewhere deeply nested, have ast-import objects in them
     global_deps, local_deps_files = set(), set()
@@ -760,143 +1247,2344 @@ def handle_ast_object(
     return global_deps, local_deps_files
 
 
-def files_in_dir(dir_path: str) -> Iterable[str]:
-    return filter(os.path.isfile, (os.path.join(dir_path, fn) for fn in os.listdir(dir_path)))
-
-
-def find_file_dependencies(
-        input_file: str, as_tree: ast.AST, args: dict[str, bool]
-) -> set[str]:
-    """Find the python dependencies used in a python file
+def audit_children(obj: ast.AST, in_function: bool) -> Iterable[tuple[bool, ast.AST]]:
+    """Iterate through the child nodes of an ast object, telling which ones run inside a function
 
-    Searches through a python file, using its AST, looking for
-    dependencies. Local imports can be filtered out. They can also
-    be `followed`. This can be configured with the `args`.
+    The body of a function (or lambda) only runs when the function is called, while its
+    decorators, default values and annotations run when it is defined.
 
     Parameters
     ----------
-    input_file : str
-        Input python file
-    as_tree : ast.AST
-        Python Abstract Syntax Tree of the python source code in the file `input_file`
-    args : dict[str, bool]
-        The command-line arguments given to this script
+    obj : ast.AST
+        Python code Abstract Syntax Tree
+    in_function : bool
+        The object itself is only executed when a function is called
 
     Returns
     -------
-    file_dependencies : set[str]
-        Set of python modules/dependencies used in the python file `input_file`
-
-    Raises
-    ------
-    AssertionError
-        The `input_file` is not an absolute path
+    children : Iterable[tuple[bool, ast.AST]]
+        The child nodes, with True when they are only executed when a function is called
 
     """
 
-    global READ_FILES
+    if in_function or type(obj) not in FUNCTION_NODE_TYPES:
+        return ((in_function, child) for child in ast.iter_child_nodes(obj))
+    body = obj.body if type(obj.body) is list else [obj.body]
+    body_ids = {id(node) for node in body}
+    return ((id(child) in body_ids, child) for child in ast.iter_child_nodes(obj))
 
-    # assert this so we know the path is unique
-    assert os.path.isabs(input_file)
 
-    # add file to the read files
-    if input_file in READ_FILES:
-        return set()
-    READ_FILES.add(input_file)
+def audit_name_uses(obj: ast.AST, in_function: bool) -> None:
+    """Record the names used in a subtree in which no imports are searched (see `LAZY_AUDIT`)
 
-    dir_path = os.path.dirname(input_file)
-    global_dependencies, local_dependencies_file_set = handle_ast_object(
-        as_tree, dir_path, args
-    )
+    Parameters
+    ----------
+    obj : ast.AST
+        Python code Abstract Syntax Tree
+    in_function : bool
+        The object is only executed when a function is called
 
-    # remove local imports? && following local imports?
-    if not args["remove_local_imports"] or args["follow_local_imports"]:
-        # go through each file
-        while local_dependencies_file_set:
-            # take next file path
-            local_import_file_path = local_dependencies_file_set.pop()
-            # get the local import name
-            local_import_name = os.path.basename(local_import_file_path)
-            vprint(f"local import name: {local_import_name}")
+    """
 
-            # add the local import ?
-            if not args["remove_local_imports"]:
-                vprint(f"adding local import: {local_import_name}")
-                global_dependencies.add(local_import_name)
+    if type(obj) is ast.Name:
+        if type(obj.ctx) is ast.Load:
+            LAZY_AUDIT["function_uses" if in_function else "module_uses"].add(obj.id)
+        return
+    for sub_in_function, sub_obj in audit_children(obj, in_function):
+        audit_name_uses(sub_obj, sub_in_function)
 
-            # follow the local import ?
-            if args["follow_local_imports"] and (
-                    as_tree := parse_python_file(local_import_file_path + ".py")
+
+def audit_import_bindings(obj: ast.Import | ast.ImportFrom) -> None:
+    """Record the names bound by a top-level import (see `LAZY_AUDIT`)
+
+    Parameters
+    ----------
+    obj : ast.Import | ast.ImportFrom
+        Import statement executed when the module is imported
+
+    """
+
+    for alias in obj.names:
+        if alias.name == "*":
+            continue
+        if type(obj) is ast.Import:
+            module_name = alias.name
+            bound_name = alias.asname or alias.name.split(".")[0]
+        else:
+            module_name = f"{'.' * obj.level}{obj.module or ''}"
+            module_name += f"{'' if module_name.endswith('.') else '.'}{alias.name}"
+            bound_name = alias.asname or alias.name
+        LAZY_AUDIT["bindings"].setdefault(bound_name, (getattr(obj, "lineno", 0), module_name))
+
+
+def record_lazy_imports(input_file: str) -> None:
+    """Add the top-level imports of a file only used inside functions to `LAZY_IMPORTS`
+
+    Parameters
+    ----------
+    input_file : str
+        Path of the python file whose imports were just searched
+
+    """
+
+    for bound_name, (lineno, module_name) in LAZY_AUDIT["bindings"].items():
+        if bound_name in LAZY_AUDIT["function_uses"] and bound_name not in LAZY_AUDIT["module_uses"]:
+            LAZY_IMPORTS.append((input_file, lineno, module_name, bound_name))
+
+
+def files_in_dir(dir_path: str) -> Iterable[str]:
+    """Get the paths of the files in a directory
+
+    The listings are cached in `DIR_INDEX`, along with the modification time of the
+    directory (which changes when files are added or removed), so successive calls
+    only cost a stat of the directory. When scanning a git revision, the listing
+    comes from its tree.
+
+    Parameters
+    ----------
+    dir_path : str
+        Path of the directory
+
+    Returns
+    -------
+    file_paths : Iterable[str]
+        Paths of the files in the directory
+
+    """
+
+    if GIT_FILES is not None:
+        return GIT_DIRS.get(dir_path, [])
+    if CONSULTED_DIRS is not None:
+        CONSULTED_DIRS.add(dir_path)
+    try:
+        mtime = os.stat(dir_path).st_mtime_ns
+    except OSError:
+        return []
+    cached = DIR_INDEX.get(dir_path)
+    if cached is None or cached[0] != mtime:
+        with os.scandir(dir_path) as entries:
+            cached = DIR_INDEX[dir_path] = (mtime, [entry.path for entry in entries if entry.is_file()])
+    return cached[1]
+
+
+def path_is_file(path: str) -> bool:
+    """os.path.isfile, or a lookup in the tree of the scanned git revision"""
+
+    if CONSULTED_DIRS is not None:
+        CONSULTED_DIRS.add(os.path.dirname(path))
+    return os.path.isfile(path) if GIT_FILES is None else path in GIT_FILES
+
+
+def path_is_dir(path: str) -> bool:
+    """os.path.isdir, or a lookup in the tree of the scanned git revision"""
+
+    if CONSULTED_DIRS is not None:
+        CONSULTED_DIRS.add(os.path.dirname(path))
+    return os.path.isdir(path) if GIT_FILES is None else path in GIT_DIRS
+
+
+def find_file_dependencies(
+        input_file: str, as_tree: ast.AST, args: dict[str, bool], local_dependencies: set[str] | None = None
+) -> set[str]:
+    """Find the python dependencies used in a python file
+
+    Searches through a python file, using its AST, looking for
+    dependencies. Local imports can be filtered out. They can also
+    be `followed`. This can be configured with the `args`.
+
+    Parameters
+    ----------
+    input_file : str
+        Input python file
+    as_tree : ast.AST
+        Python Abstract Syntax Tree of the python source code in the file `input_file`
+    args : dict[str, bool]
+        The command-line arguments given to this script
+    local_dependencies : set[str] | None
+        If given, the local import names are added to this set instead of the
+        returned one (used to keep them apart until the removal policy is applied)
+
+    Returns
+    -------
+    file_dependencies : set[str]
+        Set of python modules/dependencies used in the python file `input_file`
+
+    Raises
+    ------
+    AssertionError
+        The `input_file` is not an absolute path
+
+    """
+
+    global READ_FILES
+
+    # assert this so we know the path is unique
+    assert os.path.isabs(input_file)
+
+    # add file to the read files
+    if input_file in READ_FILES:
+        return set()
+    READ_FILES.add(input_file)
+
+    dir_path = os.path.dirname(input_file)
+    global_dependencies, local_dependencies_file_set = search_ast_imports(
+        input_file, as_tree, dir_path, args
+    )
+
+    # remove local imports? && following local imports?
+    if not args["remove_local_imports"] or args["follow_local_imports"]:
+        # go through each file
+        while local_dependencies_file_set:
+            # take next file path
+            local_import_file_path = local_dependencies_file_set.pop()
+            # get the local import name
+            local_import_name = os.path.basename(local_import_file_path)
+            vprint(f"local import name: {local_import_name}")
+
+            # add the local import ?
+            if not args["remove_local_imports"]:
+                vprint(f"adding local import: {local_import_name}")
+                if local_dependencies is None:
+                    global_dependencies.add(local_import_name)
+                else:
+                    local_dependencies.add(local_import_name)
+
+            # follow the local import ?
+            if args["follow_local_imports"] and (
+                    as_tree := parse_python_file(local_import_file_path + ".py", args)
             ):
                 # TODO: make sure we don't follow circular imports
                 # python only seems to accept *.py files
                 vprint(f"following local import: {local_import_name}")
                 global_dependencies |= find_file_dependencies(
-                    local_import_file_path, as_tree, args
+                    local_import_file_path, as_tree, args, local_dependencies
                 )
 
-    return global_dependencies
+    return global_dependencies
+
+
+def search_ast_imports(
+        input_file: str, as_tree: ast.AST, dir_path: str, args: dict[str, bool]
+) -> tuple[set[str], set[str]]:
+    """Search the imports of a whole file, within its time budget
+
+    Calls `handle_ast_object` on the tree of the file. If the search takes longer
+    than the --max-file-time budget, it is aborted and replaced by a cheap search,
+    which simply collects every import node of the tree (no matter if they are in
+    functions or blocks), and the file is left out of the --audit-lazy report.
+
+    Parameters
+    ----------
+    input_file : str
+        Path of the python file
+    as_tree : ast.AST
+        Python Abstract Syntax Tree of the python source code in the file `input_file`
+    dir_path : str
+        Directory of the python file
+    args : dict[str, bool]
+        The command-line arguments given to this script
+
+    Returns
+    -------
+    all_imports : tuple[set[str], set[str]]
+        global_imports : set[str]
+            Global imports
+        local_import_files : set[str]
+            Set of the files that are imported locally
+
+    """
+
+    global WALK_DEADLINE, LAZY_AUDIT
+
+    start = time.perf_counter()
+    if args.get("max_file_time") is not None:
+        WALK_DEADLINE = start + args["max_file_time"]
+    if args.get("audit_lazy"):
+        LAZY_AUDIT = {"bindings": dict(), "module_uses": set(), "function_uses": set()}
+    try:
+        all_imports = handle_ast_object(as_tree, dir_path, args)
+        if LAZY_AUDIT is not None:
+            record_lazy_imports(input_file)
+        return all_imports
+    except BudgetExceeded:
+        reason = f"import search took more than {args['max_file_time']}s"
+        vprint(f"WARNING: {reason}, falling back to a cheap search: {input_file}")
+        OVER_BUDGET_FILES.append((input_file, f"{reason} (scan)"))
+        WALK_DEADLINE = None
+        LAZY_AUDIT = None
+        import_tree = ast.Module(
+            body=[node for node in ast.walk(as_tree) if type(node) in (ast.Import, ast.ImportFrom)],
+            type_ignores=[],
+        )
+        return handle_ast_object(import_tree, dir_path, args)
+    finally:
+        WALK_DEADLINE = None
+        LAZY_AUDIT = None
+        STATS["search_time"] += time.perf_counter() - start
+
+
+def is_generated_source(content: str) -> bool:
+    """Tell if python source code was generated, looking for markers in its first bytes
+
+    Parameters
+    ----------
+    content : str
+        Python source code
+
+    Returns
+    -------
+    generated : bool
+        True if one of the `GENERATED_FILE_MARKERS` is in the header of the source code
+
+    """
+
+    header = content[:GENERATED_HEADER_SIZE]
+    return any(marker in header for marker in GENERATED_FILE_MARKERS)
+
+
+def cheap_import_tree(content: str) -> ast.Module:
+    """Build a tree containing the imports of some python source code, without parsing it
+
+    The import statements are found using a line-based regular expression. This is
+    much faster than parsing the source code, but not exact: imports in strings are
+    found, and the context of the imports (functions, blocks) is lost. Only the
+    import nodes are built, so the tree can be given to `handle_ast_object`.
+
+    Parameters
+    ----------
+    content : str
+        Python source code
+
+    Returns
+    -------
+    tree : ast.Module
+        Module whose body is the list of the found ast.Import and ast.ImportFrom objects
+
+    """
+
+    body: list[ast.stmt] = list()
+    for match in CHEAP_IMPORT_REGEX.finditer(content):
+        from_module, from_names, import_names = match.groups()
+        names = from_names if import_names is None else import_names
+        aliases = [
+            ast.alias(name=name_expr.split()[0], asname=None)
+            for name_expr in names.strip("()").replace("\\", " ").replace("\n", ",").split(",")
+            if name_expr.split() and re.fullmatch(r"[\w.*]+", name_expr.split()[0])
+        ]
+        if not aliases:
+            continue
+        if import_names is not None:
+            body.append(ast.Import(names=aliases))
+        else:
+            module = from_module.lstrip(".")
+            level = len(from_module) - len(module)
+            if level == 0 and not module:
+                continue
+            body.append(ast.ImportFrom(module=module or None, names=aliases, level=level))
+    return ast.Module(body=body, type_ignores=[])
+
+
+def print_stats() -> None:
+    """Print the scan statistics (`STATS` and `OVER_BUDGET_FILES`) on stderr"""
+
+    print("# Statistics", file=sys.stderr)
+    print(f"#  files parsed: {STATS['files_parsed']}", file=sys.stderr)
+    print(f"#  files cheaply scanned: {STATS['files_scanned']}", file=sys.stderr)
+    print(f"#  files read from bytecode: {STATS['files_from_bytecode']}", file=sys.stderr)
+    print(f"#  files skipped: {STATS['files_skipped']}", file=sys.stderr)
+    print(f"#  bytes read: {STATS['bytes_read']}", file=sys.stderr)
+    print(f"#  bytes skipped (--header-only): {STATS['bytes_skipped']}", file=sys.stderr)
+    print(f"#  parse time: {STATS['parse_time']:.3f}s", file=sys.stderr)
+    print(f"#  import search time: {STATS['search_time']:.3f}s", file=sys.stderr)
+    if OVER_BUDGET_FILES:
+        print(f"#  files over a budget: {len(OVER_BUDGET_FILES)}", file=sys.stderr)
+        for file_path, reason in OVER_BUDGET_FILES:
+            print(f"#   {file_path}: {reason}", file=sys.stderr)
+
+
+def cache_dir() -> str:
+    """Get (and create) the findpydeps cache directory
+
+    Returns
+    -------
+    cache_dir : str
+        "$XDG_CACHE_HOME/findpydeps", defaulting to "~/.cache/findpydeps"
+
+    """
+
+    base_dir = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    path = os.path.join(base_dir, "findpydeps")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def load_cache(file_name: str) -> dict:
+    """Load a JSON cache file from the `cache_dir` (empty dict if missing or invalid)"""
+
+    try:
+        with open(os.path.join(cache_dir(), file_name), "r") as file:
+            cache = json.load(file)
+    except (OSError, ValueError):
+        return dict()
+    return cache if type(cache) is dict else dict()
+
+
+def save_cache(file_name: str, cache: dict) -> None:
+    """Save a JSON cache file in the `cache_dir` (atomically, errors are ignored)"""
+
+    try:
+        path = os.path.join(cache_dir(), file_name)
+        with open(path + ".tmp", "w") as file:
+            json.dump(cache, file)
+        os.replace(path + ".tmp", path)
+    except OSError as ose:
+        vprint(f"WARNING: could not write the cache file {file_name}: {ose}")
+
+
+def sys_path_entries() -> list[str]:
+    """Get the absolute sys.path entries, including the directories listed in their *.pth files
+
+    Returns
+    -------
+    entries : list[str]
+        The sys.path entries, in order and without duplicates
+
+    """
+
+    entries: list[str] = list()
+    for entry in map(lambda e: os.path.abspath(e or os.curdir), sys.path):
+        if entry in entries:
+            continue
+        entries.append(entry)
+        if not os.path.isdir(entry):
+            continue
+        for pth_file in fnmatch.filter(os.listdir(entry), "*.pth"):
+            try:
+                with open(os.path.join(entry, pth_file), "r") as file:
+                    lines = file.read().splitlines()
+            except (OSError, UnicodeDecodeError):
+                continue
+            for line in map(str.strip, lines):
+                # comments and "import ..." lines are not paths
+                if not line or line.startswith(("#", "import ", "import\t")):
+                    continue
+                pth_entry = os.path.abspath(os.path.join(entry, line))
+                if pth_entry not in entries and os.path.isdir(pth_entry):
+                    entries.append(pth_entry)
+    return entries
+
+
+def top_level_names_in_entry(entry: str) -> set[str]:
+    """Get the top-level importable names in a sys.path entry (directory or zip file)
+
+    Parameters
+    ----------
+    entry : str
+        Absolute path of the sys.path entry
+
+    Returns
+    -------
+    names : set[str]
+        The package names (directories) and module names (python files, extension modules)
+
+    """
+
+    names: set[str] = set()
+    if os.path.isdir(entry):
+        with os.scandir(entry) as dir_entries:
+            children = [(dir_entry.name, dir_entry.is_dir()) for dir_entry in dir_entries]
+    elif os.path.isfile(entry):
+        # zip files are rare on the sys.path, and zipfile is slow to import: only import it if needed
+        import zipfile
+        if not zipfile.is_zipfile(entry):
+            return names
+        with zipfile.ZipFile(entry) as zip_file:
+            children = set(
+                (name.partition("/")[0], "/" in name) for name in zip_file.namelist()
+            )
+    else:
+        return names
+
+    for name, is_dir in children:
+        # packages (namespace packages included)
+        if is_dir:
+            if name.isidentifier():
+                names.add(name)
+            continue
+        # modules (e.g. "six.py", "_cffi_backend.cpython-311-x86_64-linux-gnu.so")
+        module_name, dot, _ = name.partition(".")
+        if dot and module_name.isidentifier() and name.endswith(EXTENSION_MODULE_SUFFIXES):
+            names.add(module_name)
+    return names
+
+
+def installed_top_level_names() -> set[str]:
+    """Get all the top-level names which can be imported in the current environment
+
+    The names of every sys.path entry are cached on disk (see `cache_dir`), along with
+    the modification time of the entry. Adding or removing a package or module changes
+    the modification time of the entry directory, so only the modified entries are
+    listed again.
+
+    Returns
+    -------
+    names : set[str]
+        Top-level importable names (builtin modules included)
+
+    """
+
+    cache = load_cache(SYS_PATH_INDEX_FILE)
+    cache_changed = False
+    names: set[str] = set(sys.builtin_module_names)
+
+    for entry in sys_path_entries():
+        try:
+            mtime = os.stat(entry).st_mtime_ns
+        except OSError:
+            continue
+        cached = cache.get(entry)
+        if not cached or cached.get("mtime") != mtime:
+            vprint(f"indexing sys.path entry: {entry}")
+            cached = {"mtime": mtime, "names": sorted(top_level_names_in_entry(entry))}
+            cache[entry] = cached
+            cache_changed = True
+        names.update(cached["names"])
+
+    if cache_changed:
+        save_cache(SYS_PATH_INDEX_FILE, cache)
+    return names
+
+
+def missing_installed_dependencies(dependencies: Iterable[str]) -> set[str]:
+    """Get the dependencies which cannot be imported in the current environment
+
+    Parameters
+    ----------
+    dependencies : Iterable[str]
+        Dependencies (module names, submodules are checked by their top-level name)
+
+    Returns
+    -------
+    missing : set[str]
+        The dependencies whose top-level name is not importable
+
+    """
+
+    installed = installed_top_level_names()
+    return {dep for dep in dependencies if get_module_name_in_simple_import(dep) not in installed}
+
+
+def start_progress(phase: str, total: int | None) -> None:
+    """Start showing the progress of a phase of the scan (if `SHOW_PROGRESS`)
+
+    Parameters
+    ----------
+    phase : str
+        Name of the phase (e.g. "parsing")
+    total : int | None
+        Number of files to process in this phase (None if unknown)
+
+    """
+
+    global PROGRESS
+
+    end_progress()
+    if not SHOW_PROGRESS:
+        return
+    now = time.monotonic()
+    PROGRESS = {"phase": phase, "total": total, "done": 0, "start": now, "refresh": now,
+                "bytes": STATS["bytes_read"]}
+
+
+def advance_progress(num_files: int = 1) -> None:
+    """Count processed files, and refresh the progress line a few times per second"""
+
+    if PROGRESS is None:
+        return
+    PROGRESS["done"] += num_files
+    now = time.monotonic()
+    if now >= PROGRESS["refresh"]:
+        PROGRESS["refresh"] = now + PROGRESS_REFRESH_INTERVAL
+        print_progress(now)
+
+
+def end_progress() -> None:
+    """Stop showing the progress of the current phase, erasing the progress line"""
+
+    global PROGRESS
+
+    if PROGRESS is None:
+        return
+    PROGRESS = None
+    sys.stderr.write("\r\033[K")
+    sys.stderr.flush()
+
+
+def print_progress(now: float) -> None:
+    """Print the progress line: files done/total, files/s, MB/s, ETA and phase"""
+
+    elapsed = max(now - PROGRESS["start"], 1e-9)
+    done, total = PROGRESS["done"], PROGRESS["total"]
+    files_per_second = done / elapsed
+    mb_per_second = (STATS["bytes_read"] - PROGRESS["bytes"]) / elapsed / 1e6
+    line = f"{PROGRESS['phase']}: {done}{f'/{total}' if total is not None else ''} files, " \
+           f"{files_per_second:.1f} files/s, {mb_per_second:.2f} MB/s"
+    if total is not None and files_per_second > 0:
+        eta = int((total - done) / files_per_second)
+        line += f", ETA {eta // 3600}:{eta // 60 % 60:02}:{eta % 60:02}"
+    sys.stderr.write(f"\r\033[K{line}")
+    sys.stderr.flush()
+
+
+def normalize_distribution_name(name: str) -> str:
+    """Normalize the name of a distribution (PEP 503, e.g. "Foo_Bar" becomes "foo-bar")"""
+
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def distributions_in_entry(entry: str) -> dict[str, dict]:
+    """Read the metadata of the distributions installed in a sys.path entry
+
+    Parameters
+    ----------
+    entry : str
+        Absolute path of the sys.path entry
+
+    Returns
+    -------
+    distributions : dict[str, dict]
+        For each normalized distribution name: its "name", "version", "requires"
+        (Requires-Dist) and "top_level" (importable names)
+
+    """
+
+    # importing importlib.metadata takes longer than most scans: only do it if needed
+    import importlib.metadata
+
+    distributions: dict[str, dict] = dict()
+    for distribution in importlib.metadata.distributions(path=[entry]):
+        name = distribution.metadata["Name"]
+        if not name or normalize_distribution_name(name) in distributions:
+            continue
+        # declared top-level names, or inferred from the installed files
+        top_level = (distribution.read_text("top_level.txt") or "").split()
+        if not top_level:
+            top_level = sorted(set(
+                file.parts[0].partition(".")[0] for file in distribution.files or ()
+                if file.parts[0].partition(".")[0].isidentifier()
+                and (len(file.parts) > 1 or file.suffix in EXTENSION_MODULE_SUFFIXES)
+                and not file.parts[0].endswith((".dist-info", ".egg-info"))
+            ))
+        distributions[normalize_distribution_name(name)] = {
+            "name": name,
+            "version": distribution.version,
+            "requires": distribution.requires or [],
+            "top_level": top_level,
+        }
+    return distributions
+
+
+def installed_distributions() -> dict[str, dict]:
+    """Get the metadata of all the distributions installed in the current environment
+
+    The metadata of the distributions of every sys.path entry are cached on disk (see
+    `cache_dir`), along with the modification time of the entry. Installing, upgrading
+    or removing a distribution changes the modification time of its entry directory,
+    so only the METADATA files of the modified entries are read again.
+
+    Returns
+    -------
+    distributions : dict[str, dict]
+        Metadata of the distributions (see `distributions_in_entry`), the first
+        entries of sys.path taking precedence
+
+    """
+
+    cache = load_cache(DISTRIBUTIONS_INDEX_FILE)
+    cache_changed = False
+    distributions: dict[str, dict] = dict()
+
+    for entry in sys_path_entries():
+        try:
+            mtime = os.stat(entry).st_mtime_ns
+        except OSError:
+            continue
+        cached = cache.get(entry)
+        if not cached or cached.get("mtime") != mtime:
+            vprint(f"reading the distributions of: {entry}")
+            cached = {"mtime": mtime, "distributions": distributions_in_entry(entry)}
+            cache[entry] = cached
+            cache_changed = True
+        for name, distribution in cached["distributions"].items():
+            distributions.setdefault(name, distribution)
+
+    if cache_changed:
+        save_cache(DISTRIBUTIONS_INDEX_FILE, cache)
+    return distributions
+
+
+def marker_environment() -> dict[str, str]:
+    """Get the values of the environment marker variables (PEP 508) of the current environment"""
+
+    implementation_version = sys.implementation.version
+    return {
+        "os_name": os.name,
+        "sys_platform": sys.platform,
+        "platform_machine": platform.machine(),
+        "platform_python_implementation": platform.python_implementation(),
+        "platform_release": platform.release(),
+        "platform_system": platform.system(),
+        "platform_version": platform.version(),
+        "python_version": ".".join(platform.python_version_tuple()[:2]),
+        "python_full_version": platform.python_version(),
+        "implementation_name": sys.implementation.name,
+        "implementation_version": f"{implementation_version.major}.{implementation_version.minor}."
+                                  f"{implementation_version.micro}",
+    }
+
+
+def compare_marker_values(left: str, op: str, right: str) -> bool:
+    """Compare two values of an environment marker, as versions if possible"""
+
+    if op == "in":
+        return left in right
+    if op == "not in":
+        return left not in right
+    if op == "===":
+        return left == right
+    left_version = re.match(r"\d+(?:\.\d+)*", left.strip())
+    right_version = re.match(r"\d+(?:\.\d+)*", right.strip())
+    if left_version and right_version:
+        left_key = tuple(map(int, left_version.group().split(".")))
+        right_key = tuple(map(int, right_version.group().split(".")))
+        if op == "~=":
+            return left_key >= right_key and left_key[:len(right_key) - 1] == right_key[:-1]
+        # "3.8" == "3.8.0"
+        length = max(len(left_key), len(right_key))
+        left_key += (0,) * (length - len(left_key))
+        right_key += (0,) * (length - len(right_key))
+    else:
+        left_key, right_key = left, right
+    return {
+        "==": left_key == right_key, "!=": left_key != right_key, "~=": left_key == right_key,
+        "<": left_key < right_key, "<=": left_key <= right_key,
+        ">": left_key > right_key, ">=": left_key >= right_key,
+    }[op]
+
+
+def evaluate_marker(marker: str, environment: dict[str, str]) -> bool:
+    """Evaluate an environment marker (PEP 508), e.g. 'python_version < "3.8" and extra == "test"'
+
+    Parameters
+    ----------
+    marker : str
+        Environment marker
+    environment : dict[str, str]
+        Values of the marker variables (see `marker_environment`), including "extra"
+
+    Returns
+    -------
+    result : bool
+        The value of the marker (False if it can't be parsed)
+
+    """
+
+    tokens = MARKER_TOKEN_REGEX.findall(marker)
+    position = 0
+
+    def value() -> str:
+        nonlocal position
+        token = tokens[position]
+        position += 1
+        if token[0] in "\"'":
+            return token[1:-1]
+        return environment.get(token, "")
+
+    def atom() -> bool:
+        nonlocal position
+        if tokens[position] == "(":
+            position += 1
+            result = or_expr()
+            position += 1
+            return result
+        left = value()
+        op = " ".join(tokens[position].split())
+        position += 1
+        right = value()
+        # extras are normalized names
+        if tokens[position - 1] == "extra" or tokens[position - 3] == "extra":
+            left, right = normalize_distribution_name(left), normalize_distribution_name(right)
+        return compare_marker_values(left, op, right)
+
+    def and_expr() -> bool:
+        nonlocal position
+        result = atom()
+        while position < len(tokens) and tokens[position] == "and":
+            position += 1
+            result = atom() and result
+        return result
+
+    def or_expr() -> bool:
+        nonlocal position
+        result = and_expr()
+        while position < len(tokens) and tokens[position] == "or":
+            position += 1
+            result = and_expr() or result
+        return result
+
+    try:
+        return or_expr()
+    except (IndexError, KeyError):
+        vprint(f"WARNING: could not evaluate the environment marker: {marker}")
+        return False
+
+
+def transitive_dependencies(dependencies: Iterable[str]) -> set[str]:
+    """Get the installed distributions of the dependencies, and all their requirements
+
+    Each dependency (top-level module name) is mapped to the distributions which
+    install it. Then, the requirements (Requires-Dist) of the distributions are
+    followed, evaluating their environment markers, and the extras they ask for.
+
+    Parameters
+    ----------
+    dependencies : Iterable[str]
+        Dependencies (module names, submodules are mapped by their top-level name)
+
+    Returns
+    -------
+    distributions : set[str]
+        Names of the distributions of the closure, and the dependencies which are
+        not installed (unchanged)
+
+    """
+
+    distributions = installed_distributions()
+    top_level: dict[str, list[str]] = dict()
+    for name, distribution in distributions.items():
+        for module_name in distribution["top_level"]:
+            top_level.setdefault(module_name, []).append(name)
+
+    closure: set[str] = set()
+    pending: list[tuple[str, str]] = list()
+    for dep in dependencies:
+        names = top_level.get(get_module_name_in_simple_import(dep))
+        if not names:
+            vprint(f"no installed distribution for: {dep}")
+            closure.add(dep)
+            continue
+        pending.extend((name, "") for name in names)
+
+    environment = marker_environment()
+    visited: set[tuple[str, str]] = set()
+    while pending:
+        name, extra = pending.pop()
+        if (name, extra) in visited or name not in distributions:
+            continue
+        visited.add((name, extra))
+        distribution = distributions[name]
+        closure.add(distribution["name"])
+        for requirement in distribution["requires"]:
+            match = REQUIREMENT_REGEX.match(requirement)
+            if not match:
+                continue
+            required_name, required_extras, marker = match.groups()
+            if marker and not evaluate_marker(marker, {**environment, "extra": extra}):
+                continue
+            # no "extra" marker: the requirement is already followed without extra
+            if extra and not (marker and "extra" in marker):
+                continue
+            required_name = normalize_distribution_name(required_name)
+            if required_name not in distributions:
+                vprint(f"requirement not installed: {requirement}")
+                continue
+            pending.append((required_name, ""))
+            pending.extend(
+                (required_name, normalize_distribution_name(required_extra.strip()))
+                for required_extra in (required_extras or "").split(",") if required_extra.strip()
+            )
+    return closure
+
+
+def measure_import_cost(module_name: str) -> tuple[int, int] | None:
+    """Measure the import cost of a module, in an isolated python subprocess
+
+    The module is imported by a new interpreter of the current environment, with
+    "-X importtime". The modules imported by the module are listed (indented)
+    before it, in the output. The interpreter runs in an empty directory, so the
+    files of the current directory can't shadow the module.
+
+    Parameters
+    ----------
+    module_name : str
+        Name of the module
+
+    Returns
+    -------
+    cost : tuple[int, int] | None
+        Cumulative import time (in microseconds) and number of imported modules,
+        (0, 0) if the module is already imported when the interpreter starts, or
+        None if the module can't be imported (or is not a valid module name)
+
+    """
+
+    # the name is run as code: it may come from a file name of the scanned tree
+    if not all(part.isidentifier() for part in module_name.split(".")):
+        vprint(f"WARNING: not a valid module name, import cost not measured: {module_name!r}")
+        return None
+
+    import tempfile
+
+    # "-P": don't prepend the (empty) working directory to sys.path
+    isolation = ["-P"] if sys.version_info >= (3, 11) else []
+    try:
+        with tempfile.TemporaryDirectory() as empty_dir:
+            process = subprocess.run(
+                [sys.executable, *isolation, "-X", "importtime", "-c", f"import {module_name}"],
+                capture_output=True, text=True, timeout=IMPORT_COST_TIMEOUT, cwd=empty_dir,
+            )
+    except (OSError, subprocess.TimeoutExpired) as error:
+        vprint(f"WARNING: could not measure the import cost of {module_name}: {error}")
+        return None
+    if process.returncode != 0:
+        return None
+
+    # "import time: self [us] | cumulative | imported package"
+    num_modules = 0
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        num_modules += 1
+        _, cumulative, package = line[len("import time:"):].split("|")
+        # top-level import: its nested imports are the lines since the previous one
+        if not package.startswith("  "):
+            if package.strip() == module_name:
+                return int(cumulative), num_modules
+            num_modules = 0
+    # imported successfully, but already loaded at startup (e.g. os, or by a .pth file)
+    return 0, 0
+
+
+def import_costs(dependencies: Iterable[str], num_workers: int) -> dict[str, tuple[int, int] | None]:
+    """Measure the import costs of the dependencies (see `measure_import_cost`)
+
+    The subprocesses run in a pool of `num_workers` workers. The costs are cached on
+    disk (see `cache_dir`) by interpreter and distribution version: they are only
+    measured again when the distribution is upgraded. The dependencies which are
+    neither in the stdlib nor installed by a distribution (e.g. local modules), and
+    the ones which could not be imported, are always measured.
+
+    Parameters
+    ----------
+    dependencies : Iterable[str]
+        Dependencies (module names)
+    num_workers : int
+        Number of subprocesses running at the same time
+
+    Returns
+    -------
+    costs : dict[str, tuple[int, int] | None]
+        Cumulative import time (in microseconds) and number of imported modules
+        of each dependency (None if it can't be imported)
+
+    """
+
+    distributions = installed_distributions()
+    versions: dict[str, list[str]] = {module_name: ["stdlib"] for module_name in PYTHON_STANDARD_MODULES}
+    for distribution in distributions.values():
+        for module_name in distribution["top_level"]:
+            versions.setdefault(module_name, []).append(f"{distribution['name']}=={distribution['version']}")
+
+    cache = load_cache(IMPORT_COST_FILE)
+    costs: dict[str, tuple[int, int] | None] = dict()
+    cache_keys: dict[str, str] = dict()
+    for dep in dependencies:
+        if dep in versions:
+            cache_keys[dep] = f"{sys.executable} {platform.python_version()} {dep} {' '.join(sorted(versions[dep]))}"
+            if cache.get(cache_keys[dep]) is not None:
+                costs[dep] = tuple(cache[cache_keys[dep]])
+                continue
+        costs[dep] = None
+
+    # only --import-cost needs concurrent.futures (which imports logging)
+    import concurrent.futures
+
+    to_measure = [dep for dep in costs if dep not in cache_keys or cache.get(cache_keys[dep]) is None]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(num_workers, 1)) as executor:
+        for dep, cost in zip(to_measure, executor.map(measure_import_cost, to_measure)):
+            vprint(f"import cost of {dep}: {cost}")
+            costs[dep] = cost
+            if dep in cache_keys and cost is not None:
+                cache[cache_keys[dep]] = cost
+
+    if any(dep in cache_keys for dep in to_measure):
+        save_cache(IMPORT_COST_FILE, cache)
+    return costs
+
+
+def file_in_shard(file_path: str, index: int, count: int) -> bool:
+    """Tell if a file belongs to the shard `index` (1-based) out of `count`
+
+    The partition is done on a CRC32 of the path relative to the working directory,
+    so every node of a CI fan-out computes the same partition of the same checkout.
+
+    Parameters
+    ----------
+    file_path : str
+        Absolute path of the input file
+    index : int
+        Index of the shard, starting at 1
+    count : int
+        Total number of shards
+
+    Returns
+    -------
+    in_shard : bool
+        True if the file must be scanned by the shard `index`
+
+    """
+
+    rel_path = os.path.relpath(file_path).replace(os.sep, "/")
+    return zlib.crc32(rel_path.encode("utf-8", "surrogateescape")) % count == index - 1
+
+
+def write_partial(
+        output_path: str, global_dependencies: set[str], local_dependencies: set[str], args: dict[str, bool]
+) -> None:
+    """Write the partial result of a sharded scan (see `run_merge`)
+
+    The output is a JSON document. The global dependencies and the local import
+    names are kept apart, so the removal policy can be applied at merge time.
+    The options which change the scan results are recorded to make sure only
+    compatible partials are merged.
+
+    Parameters
+    ----------
+    output_path : str
+        Path of the partial result file ("-" for stdout)
+    global_dependencies : set[str]
+        Global dependencies found in the shard (stdlib modules included)
+    local_dependencies : set[str]
+        Local import names found in the shard
+    args : dict[str, bool]
+        The command-line arguments given to this script
+
+    """
+
+    partial = {
+        "format": PARTIAL_FORMAT,
+        "version": PARTIAL_VERSION,
+        "shard": list(args["shard"]),
+        "options": {
+            key: args[key] for key in (
+                "dir_scanning_expr", "follow_local_imports", "blocks", "functions", "submodules", "header_only",
+                "max_file_size", "max_file_time", "detect_generated", "over_budget",
+            )
+        },
+        "dependencies": sorted(global_dependencies),
+        "local": sorted(local_dependencies),
+    }
+    if output_path == "-":
+        json.dump(partial, sys.stdout, indent=1)
+        print()
+    else:
+        with open(output_path, "w") as file:
+            json.dump(partial, file, indent=1)
+
+
+def read_partial(partial_path: str) -> dict:
+    """Read a partial result file written by `write_partial`
+
+    Parameters
+    ----------
+    partial_path : str
+        Path of the partial result file ("-" for stdin)
+
+    Returns
+    -------
+    partial : dict
+        The decoded partial result
+
+    Raises
+    ------
+    ArgumentError
+        The file is not a partial result of this version of findpydeps
+
+    """
+
+    try:
+        if partial_path == "-":
+            partial = json.load(sys.stdin)
+        else:
+            with open(partial_path, "r") as file:
+                partial = json.load(file)
+    except ValueError as ve:
+        raise ArgumentError(f'Invalid partial result file "{partial_path}": {ve}')
+    if (
+            type(partial) is not dict
+            or partial.get("format") != PARTIAL_FORMAT
+            or partial.get("version") != PARTIAL_VERSION
+    ):
+        raise ArgumentError(f'"{partial_path}" is not a findpydeps partial result (version {PARTIAL_VERSION})')
+    return partial
+
+
+def resolve_local_import_file(local_import_path: str) -> str:
+    """Get the file a local import refers to
+
+    The local imports found by `handle_ast_object` have no extension. They refer
+    either to a python file ("path.py") or to a package ("path/__init__.py").
+
+    Parameters
+    ----------
+    local_import_path : str
+        Path of a local import, without extension
+
+    Returns
+    -------
+    file_path : str
+        Path of the imported file, or `local_import_path` if there is no such
+        file (e.g. namespace packages)
+
+    """
+
+    if path_is_file(local_import_path + ".py"):
+        return local_import_path + ".py"
+    if path_is_file(init_path := os.path.join(local_import_path, "__init__.py")):
+        return init_path
+    return local_import_path
+
+
+def local_import_name(file_path: str) -> str:
+    """Get the local import name of a file resolved by `resolve_local_import_file`"""
+
+    if os.path.basename(file_path) == "__init__.py":
+        file_path = os.path.dirname(file_path)
+    return os.path.splitext(os.path.basename(file_path))[0]
+
+
+def local_import_edges(file_path: str, local_imports: Iterable[str]) -> set[str]:
+    """Get the files imported by the local imports of a file
+
+    Importing a module of a package also runs the "__init__.py" file of the
+    package, so it is also part of the imported files.
+
+    Parameters
+    ----------
+    file_path : str
+        Path of the importing file
+    local_imports : Iterable[str]
+        Local imports of the file, as returned by `handle_ast_object`
+
+    Returns
+    -------
+    imported_files : set[str]
+        Paths of the imported files
+
+    """
+
+    imported_files: set[str] = set()
+    for local_import_path in local_imports:
+        imported_file = resolve_local_import_file(local_import_path)
+        imported_files.add(imported_file)
+        init_path = os.path.join(os.path.dirname(imported_file), "__init__.py")
+        if imported_file != init_path and path_is_file(init_path):
+            imported_files.add(init_path)
+    imported_files.discard(file_path)
+    return imported_files
+
+
+def reverse_local_import_graph(input_files: Iterable[str], args: dict[str, bool]) -> dict[str, set[str]]:
+    """Build the reverse local-import graph of the input files, in a single scan
+
+    Parameters
+    ----------
+    input_files : Iterable[str]
+        Absolute paths of the python files
+    args : dict[str, bool]
+        The command-line arguments given to this script
+
+    Returns
+    -------
+    importers : dict[str, set[str]]
+        For each imported file, the set of the input files which import it directly
+
+    """
+
+    importers: dict[str, set[str]] = dict()
+    start_progress("local imports", len(input_files) if hasattr(input_files, "__len__") else None)
+    for input_file in input_files:
+        advance_progress()
+        vprint(f'Searching local imports of: "{input_file}"')
+        if not (as_tree := parse_python_file(input_file, args)):
+            continue
+        _, local_imports = search_ast_imports(input_file, as_tree, os.path.dirname(input_file), args)
+        for imported_file in local_import_edges(input_file, local_imports):
+            importers.setdefault(imported_file, set()).add(input_file)
+    end_progress()
+    return importers
+
+
+def affected_files(
+        changed_files: Iterable[str], importers: dict[str, set[str]], input_files: Iterable[str]
+) -> set[str]:
+    """Get the files which transitively import any of the changed files
+
+    Parameters
+    ----------
+    changed_files : Iterable[str]
+        Paths of the changed files
+    importers : dict[str, set[str]]
+        Reverse local-import graph (see `reverse_local_import_graph`)
+    input_files : Iterable[str]
+        Absolute paths of the scanned files
+
+    Returns
+    -------
+    affected : set[str]
+        The (transitive) importers of the changed files, and the changed files
+        which are scanned files themselves
+
+    """
+
+    pending = [os.path.abspath(file_path) for file_path in changed_files]
+    affected = set(pending) & set(input_files)
+    visited = set(pending)
+    while pending:
+        for importer in importers.get(pending.pop(), ()):
+            affected.add(importer)
+            if importer not in visited:
+                visited.add(importer)
+                pending.append(importer)
+    return affected
+
+
+def open_index(db_path: str) -> sqlite3.Connection:
+    """Open the persistent import index, creating its tables if needed
+
+    Tables of the index:
+     * meta: the options which change the scan results
+     * files: path and fingerprint (modification time and size) of the indexed files
+     * imports: global imports of the files (one row per file and module)
+     * local_edges: local imports of the files, resolved to the imported file
+     * dirs: path, modification time and listing checksum of the directories whose
+       listing tells the local imports apart from the global ones
+     * file_dirs: the directories (of `dirs`) looked at for each file
+
+    Parameters
+    ----------
+    db_path : str
+        Path of the SQLite database
+
+    Returns
+    -------
+    connection : sqlite3.Connection
+        Connection to the database
+
+    """
+
+    # only the index sub-command needs sqlite3
+    import sqlite3
+
+    connection = sqlite3.connect(db_path)
+    connection.executescript(INDEX_SCHEMA)
+    return connection
+
+
+def update_index(
+        connection: sqlite3.Connection, input_files: list[str], roots: list[str], args: dict[str, bool]
+) -> tuple[int, int, int]:
+    """Update the persistent import index incrementally
+
+    Only the new and modified files (the fingerprint is their modification time and
+    size) are parsed, along with the files whose imports were told local or global by
+    a directory which changed since (a module was added or removed next to the
+    imported name). The indexed files under the `roots` which are not input files
+    anymore are removed from the index. The whole index is rebuilt if the options
+    which change the scan results are not the ones of the index.
+
+    Parameters
+    ----------
+    connection : sqlite3.Connection
+        Connection to the index (see `open_index`)
+    input_files : list[str]
+        Absolute paths of the python files to index
+    roots : list[str]
+        Absolute paths of the scanned inputs (files and directories)
+    args : dict[str, bool]
+        The command-line arguments given to this script
+
+    Returns
+    -------
+    counts : tuple[int, int, int]
+        Number of indexed input files, of (re-)indexed files and of removed files
+
+    """
+
+    global CONSULTED_DIRS
+
+    # the modification time of a directory also changes for unrelated files (e.g. the
+    # journal of the index): only the python files and the subdirectories matter
+    def dir_fingerprint(dir_path: str) -> tuple[int, int]:
+        try:
+            with os.scandir(dir_path) as entries:
+                names = sorted(entry.name for entry in entries if ".py" in entry.name or entry.is_dir())
+            return os.stat(dir_path).st_mtime_ns, zlib.crc32("\0".join(names).encode(errors="surrogateescape"))
+        except OSError:
+            return -1, -1
+
+    options = json.dumps(
+        {"version": INDEX_VERSION, **{key: args[key] for key in ("blocks", "functions", "submodules")}}, sort_keys=True
+    )
+    with connection:
+        row = connection.execute("SELECT value FROM meta WHERE key = 'options'").fetchone()
+        if row is None or row[0] != options:
+            vprint("index options changed: rebuilding the whole index")
+            connection.executescript(
+                "DELETE FROM files; DELETE FROM imports; DELETE FROM local_edges; DELETE FROM dirs; "
+                "DELETE FROM file_dirs;"
+            )
+            connection.execute("INSERT OR REPLACE INTO meta VALUES ('options', ?)", (options,))
+        fingerprints = dict(
+            (path, (mtime_ns, size)) for path, mtime_ns, size in connection.execute("SELECT * FROM files")
+        )
+        # files whose local imports may have changed
+        stale_files: set[str] = set()
+        dir_fingerprints: dict[str, tuple[int, int]] = dict()
+        for dir_path, mtime_ns, listing in connection.execute("SELECT * FROM dirs").fetchall():
+            try:
+                if os.stat(dir_path).st_mtime_ns == mtime_ns:
+                    continue
+            except OSError:
+                if mtime_ns == -1:
+                    continue
+            dir_fingerprints[dir_path] = dir_fingerprint(dir_path)
+            if dir_fingerprints[dir_path][1] == listing:
+                connection.execute("UPDATE dirs SET mtime_ns = ? WHERE path = ?", (dir_fingerprints[dir_path][0], dir_path))
+                continue
+            # the row is updated when the files are re-indexed
+            vprint(f"directory changed: {dir_path}")
+            stale_files.update(
+                path for (path,) in connection.execute("SELECT path FROM file_dirs WHERE dir = ?", (dir_path,))
+            )
+
+    # remove the deleted files
+    input_file_set = set(input_files)
+    removed_files = [
+        (path,) for path in fingerprints
+        if path not in input_file_set and any(path == root or path.startswith(root + os.sep) for root in roots)
+    ]
+
+    # (re-)index the new and modified files
+    num_updated = 0
+    with connection:
+        connection.executemany("DELETE FROM files WHERE path = ?", removed_files)
+        connection.executemany("DELETE FROM imports WHERE path = ?", removed_files)
+        connection.executemany("DELETE FROM local_edges WHERE path = ?", removed_files)
+        connection.executemany("DELETE FROM file_dirs WHERE path = ?", removed_files)
+        start_progress("indexing", len(input_files))
+        for input_file in input_files:
+            advance_progress()
+            try:
+                stat = os.stat(input_file)
+            except OSError:
+                continue
+            if fingerprints.get(input_file) == (stat.st_mtime_ns, stat.st_size) and input_file not in stale_files:
+                continue
+            vprint(f"indexing: {input_file}")
+            num_updated += 1
+            global_imports, local_imports = set(), set()
+            CONSULTED_DIRS = set()
+            try:
+                if as_tree := parse_python_file(input_file, args):
+                    global_imports, local_imports = handle_ast_object(as_tree, os.path.dirname(input_file), args)
+                local_edges = {resolve_local_import_file(path) for path in local_imports}
+                consulted_dirs = CONSULTED_DIRS
+            finally:
+                CONSULTED_DIRS = None
+            connection.execute("DELETE FROM imports WHERE path = ?", (input_file,))
+            connection.execute("DELETE FROM local_edges WHERE path = ?", (input_file,))
+            connection.execute("DELETE FROM file_dirs WHERE path = ?", (input_file,))
+            connection.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?)", (input_file, stat.st_mtime_ns, stat.st_size)
+            )
+            connection.executemany(
+                "INSERT OR IGNORE INTO imports VALUES (?, ?)", ((input_file, module) for module in global_imports)
+            )
+            connection.executemany(
+                "INSERT OR IGNORE INTO local_edges VALUES (?, ?)",
+                ((input_file, target) for target in local_edges),
+            )
+            connection.executemany(
+                "INSERT OR IGNORE INTO file_dirs VALUES (?, ?)", ((input_file, path) for path in consulted_dirs)
+            )
+            for path in consulted_dirs - dir_fingerprints.keys():
+                dir_fingerprints[path] = dir_fingerprint(path)
+            connection.executemany(
+                "INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)",
+                ((path, *dir_fingerprints[path]) for path in consulted_dirs),
+            )
+        end_progress()
+        connection.execute("DELETE FROM dirs WHERE path NOT IN (SELECT dir FROM file_dirs)")
+
+    return len(input_files), num_updated, len(removed_files)
+
+
+def parse_python_file(file_path: str, args: dict[str, bool] | None = None) -> ast.AST | None:
+    """Parse the input file into an AST
+
+    Parse the python source code input file into a python
+    Abstract Syntax Tree (from ast.AST). Files over a budget (size,
+    generated files) are not parsed: depending on the --over-budget
+    action, they are either cheaply scanned for imports (see
+    `cheap_import_tree`) or skipped (without being read, for the size).
+    Files whose parsing is slower than --max-file-time are only reported.
+
+    Parameters
+    ----------
+    file_path : str
+        Path of the python source code file
+    args : dict[str, bool] | None
+        The command-line arguments given to this script (no budgets if None)
+
+    Returns
+    -------
+    tree : ast.AST
+        Abstract Syntax Tree of the python file `file_path`
+
+    """
+
+    # no stat here: a missing file is found when opening it (see `open_source_file`)
+    if GIT_FILES is not None and file_path not in GIT_FILES:
+        vprint(f"WARNING: input file does not exist: {file_path}")
+        return None
+
+    args = args or dict()
+    # only the module preamble ?
+    if args.get("header_only"):
+        return parse_module_header(file_path)
+
+    # up-to-date bytecode ? (the blocks can't be told apart in bytecode)
+    if args.get("bytecode") and args.get("blocks", True) and GIT_FILES is None:
+        if (import_tree := bytecode_import_tree(file_path, args)) is not None:
+            vprint(f"imports read from bytecode: {file_path}")
+            STATS["files_from_bytecode"] += 1
+            return import_tree
+
+    # the files skipped for their size are never read
+    def size_over_budget(size: int) -> str | None:
+        if args.get("max_file_size") is not None and size > args["max_file_size"]:
+            return f"size {size} > {args['max_file_size']} bytes"
+        return None
+
+    skip_over_budget = args.get("over_budget", "scan") == "skip"
+    if GIT_FILES is None:
+        if (file := open_source_file(file_path, "r")) is None:
+            return None
+        with file:
+            size = os.fstat(file.fileno()).st_size
+            if (reason := size_over_budget(size)) and skip_over_budget:
+                return over_budget_tree(file_path, "", reason, args)
+            try:
+                content = file.read()
+            except UnicodeDecodeError:
+                return None
+    else:
+        blob = read_git_blob(file_path)
+        size = len(blob)
+        if (reason := size_over_budget(size)) and skip_over_budget:
+            return over_budget_tree(file_path, "", reason, args)
+        try:
+            content = blob.decode("utf-8")
+        except UnicodeDecodeError:
+            return None
+    STATS["bytes_read"] += size
+
+    # is the file over a budget ?
+    if reason:
+        return over_budget_tree(file_path, content, reason, args)
+    if args.get("detect_generated") and is_generated_source(content):
+        return over_budget_tree(file_path, content, "generated file", args)
+
+    start = time.perf_counter()
+    try:
+        as_tree: ast.AST = ast.parse(content)
+    except SyntaxError as se:
+        vprint(f"Failed: {se}")
+        return None
+    finally:
+        parse_time = time.perf_counter() - start
+        STATS["parse_time"] += parse_time
+
+    # the parsing can't be interrupted: the tree is kept, the file is only reported
+    if args.get("max_file_time") is not None and parse_time > args["max_file_time"]:
+        vprint(f"WARNING: parsing took {parse_time:.3f}s: {file_path}")
+        OVER_BUDGET_FILES.append((file_path, f"parsing took {parse_time:.3f}s (parsed)"))
+
+    STATS["files_parsed"] += 1
+    return as_tree
+
+
+def open_source_file(file_path: str, mode: str) -> io.IOBase | None:
+    """Open a python source code file, or return None (with a warning) if it can't be opened"""
+
+    try:
+        return open(file_path, mode)
+    except OSError as ose:
+        vprint(f"WARNING: input file can't be read: {file_path} ({ose.strerror})")
+        return None
+
+
+def parse_module_header(file_path: str) -> ast.AST | None:
+    """Parse the module preamble of a python file into an AST
+
+    The file is tokenized line by line, and the reading stops at the first
+    top-level statement which is not an import, a docstring or an import guard.
+    An import guard is a 'try' or 'if' statement (with their 'except', 'else', ...
+    clauses) whose blocks only hold imports, 'pass', 'raise', nested guards and
+    fallback assignments ('name = ...'). Only the source before this statement is
+    parsed, the rest of the file is never read.
+
+    Parameters
+    ----------
+    file_path : str
+        Path of the python source code file
+
+    Returns
+    -------
+    tree : ast.AST | None
+        Abstract Syntax Tree of the module preamble of the file `file_path`
+
+    """
+
+    lines: list[bytes] = list()
+    end: tuple[int, int] | None = None
+    encoding = "utf-8"
+    if GIT_FILES is None:
+        if (file := open_source_file(file_path, "rb")) is None:
+            return None
+    else:
+        file = io.BytesIO(read_git_blob(file_path))
+    with file:
+        size = os.fstat(file.fileno()).st_size if GIT_FILES is None else len(file.getvalue())
+
+        def readline() -> bytes:
+            line = file.readline()
+            lines.append(line)
+            return line
+
+        indent = 0
+        brackets = 0
+        statement_start = True
+        # the statements after the ':' of a clause, on the same line, are in its block
+        in_clause_header = False
+        inline_block = False
+        # start of the current top-level statement (of the whole 'try'/'if' statement, for a guard)
+        statement_begin: tuple[int, int] | None = None
+        fallback_assignment = False
+        try:
+            for token in tokenize.tokenize(readline):
+                if token.type == tokenize.ENCODING:
+                    encoding = token.string
+                elif token.type == tokenize.INDENT:
+                    indent += 1
+                elif token.type == tokenize.DEDENT:
+                    indent -= 1
+                elif token.type == tokenize.NEWLINE:
+                    statement_start = True
+                    in_clause_header = inline_block = False
+                elif token.type in (tokenize.NL, tokenize.COMMENT, tokenize.ENDMARKER):
+                    continue
+                elif fallback_assignment:
+                    # a block statement starting with a name, only 'name = ...' is allowed
+                    fallback_assignment = False
+                    if not (token.type == tokenize.OP and token.string == "="):
+                        end = statement_begin
+                        break
+                elif statement_start:
+                    statement_start = False
+                    word = token.string if token.type == tokenize.NAME else None
+                    if indent == 0 and not inline_block:
+                        if word not in COMPOUND_STATEMENT_KEYWORDS - {"try", "if"}:
+                            statement_begin = token.start
+                        if token.type != tokenize.STRING and word not in HEADER_STATEMENT_KEYWORDS:
+                            end = token.start
+                            break
+                    elif token.type == tokenize.NAME and word not in GUARD_STATEMENT_KEYWORDS:
+                        fallback_assignment = True
+                    elif word not in GUARD_STATEMENT_KEYWORDS:
+                        end = statement_begin
+                        break
+                    in_clause_header = word in COMPOUND_STATEMENT_KEYWORDS
+                elif token.type == tokenize.OP:
+                    if token.string in "([{":
+                        brackets += 1
+                    elif token.string in ")]}":
+                        brackets -= 1
+                    elif brackets == 0 and token.string == ";":
+                        statement_start = True
+                    elif brackets == 0 and token.string == ":" and in_clause_header:
+                        statement_start = inline_block = True
+                        in_clause_header = False
+        except (tokenize.TokenError, SyntaxError) as error:
+            vprint(f"Failed: {error}")
+            return None
+
+    # cut the source at the (column of the) first statement out of the preamble
+    if end is None:
+        header = b"".join(lines)
+    else:
+        end_line, end_column = end
+        header = b"".join(lines[:end_line - 1]) + lines[end_line - 1].decode(encoding)[:end_column].encode(encoding)
+    bytes_read = sum(map(len, lines))
+    STATS["bytes_read"] += bytes_read
+    STATS["bytes_skipped"] += size - bytes_read
+    vprint(f"header only: parsing {len(header)} bytes, {size - bytes_read} bytes skipped")
+
+    start = time.perf_counter()
+    try:
+        as_tree: ast.AST = ast.parse(header)
+    except (SyntaxError, ValueError) as error:
+        vprint(f"Failed: {error}")
+        return None
+    finally:
+        STATS["parse_time"] += time.perf_counter() - start
+
+    STATS["files_parsed"] += 1
+    return as_tree
+
+
+def bytecode_import_tree(file_path: str, args: dict[str, bool]) -> ast.Module | None:
+    """Build a tree containing the imports of a python file, from its cached bytecode
+
+    The bytecode file (in "__pycache__") is only used if it is up-to-date: its
+    header must match the modification time and size of the source file or, for
+    hash-based bytecode files, the hash of the source file. The IMPORT_NAME
+    instructions of the code objects are then turned back into ast.Import and
+    ast.ImportFrom objects, so the tree can be given to `handle_ast_object`.
+
+    Functions (but not async functions) are skipped, as `handle_ast_object` does,
+    unless args["functions"] is set. Blocks can't be found in bytecode, and the
+    imports in blocks removed by the compiler (e.g. "if False:") are lost.
+
+    Parameters
+    ----------
+    file_path : str
+        Path of the python source code file
+    args : dict[str, bool]
+        The command-line arguments given to this script
+
+    Returns
+    -------
+    tree : ast.Module | None
+        Module whose body is the list of the imports, or None if there is no
+        up-to-date bytecode for the file
+
+    """
+
+    try:
+        pyc_path = importlib.util.cache_from_source(file_path)
+        with open(pyc_path, "rb") as file:
+            data = file.read()
+    except (OSError, NotImplementedError, ValueError):
+        return None
+
+    # header: magic number, flags, then (mtime, size) or the source hash
+    if len(data) < 16 or data[:4] != importlib.util.MAGIC_NUMBER:
+        return None
+    flags = int.from_bytes(data[4:8], "little")
+    try:
+        if flags & 0b1:
+            with open(file_path, "rb") as file:
+                if data[8:16] != importlib.util.source_hash(file.read()):
+                    return None
+        else:
+            stat = os.stat(file_path)
+            if (
+                    int.from_bytes(data[8:12], "little") != int(stat.st_mtime) & 0xFFFFFFFF
+                    or int.from_bytes(data[12:16], "little") != stat.st_size & 0xFFFFFFFF
+            ):
+                return None
+        code = marshal.loads(data[16:])
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    if type(code) is not types.CodeType:
+        return None
+
+    body: list[ast.stmt] = list()
+    code_objects: list[types.CodeType] = [code]
+    while code_objects:
+        code = code_objects.pop()
+        body.extend(imports_from_code_object(code))
+        for const in code.co_consts:
+            if type(const) is not types.CodeType:
+                continue
+            # same as the ast.FunctionDef objects in `handle_ast_object`
+            if (
+                    not args.get("functions", True)
+                    and const.co_flags & CO_OPTIMIZED
+                    and not const.co_flags & (CO_COROUTINE | CO_ASYNC_GENERATOR)
+            ):
+                continue
+            code_objects.append(const)
+    return ast.Module(body=body, type_ignores=[])
+
+
+def imports_from_code_object(code: types.CodeType) -> list[ast.Import | ast.ImportFrom]:
+    """Get the imports done directly in a code object (not in the nested ones)
+
+    An import compiles to "LOAD_CONST level; LOAD_CONST fromlist; IMPORT_NAME module"
+    (the level is loaded by other opcodes in some python versions, e.g. LOAD_SMALL_INT
+    in 3.14, so the values of the two instructions before IMPORT_NAME are used,
+    whatever their opcode). Without a fromlist, it is a simple import (e.g. "import a.b"). Otherwise, it is a
+    from-import (e.g. "from ..a import b, c" has the level 2 and the fromlist ("b", "c")).
+
+    Parameters
+    ----------
+    code : types.CodeType
+        Python code object
+
+    Returns
+    -------
+    imports : list[ast.Import | ast.ImportFrom]
+        Python import objects
+
+    """
+
+    imports: list[ast.Import | ast.ImportFrom] = list()
+    # values of the two last instructions
+    arguments: list = [None, None]
+    for instruction in dis.get_instructions(code):
+        if instruction.opname == "IMPORT_NAME":
+            level, fromlist = arguments
+            if fromlist is None:
+                imports.append(ast.Import(names=[ast.alias(name=instruction.argval, asname=None)]))
+            else:
+                imports.append(ast.ImportFrom(
+                    module=instruction.argval or None,
+                    names=[ast.alias(name=name, asname=None) for name in fromlist],
+                    level=level or 0,
+                ))
+        arguments = [arguments[1], instruction.argval]
+    return imports
+
+
+def parse_python_source(source: str | bytes, args: dict[str, bool] | None = None) -> ast.AST:
+    """Parse python source code into an AST, even if it is not valid (yet)
+
+    Used for source code which is not in a file (e.g. an editor buffer, which is
+    often being edited): if the source code is not valid, its imports are found
+    with a cheap scan (see `cheap_import_tree`).
+
+    Parameters
+    ----------
+    source : str | bytes
+        Python source code
+    args : dict[str, bool] | None
+        The command-line arguments given to this script
+
+    Returns
+    -------
+    tree : ast.AST
+        Abstract Syntax Tree of the source code
+
+    """
+
+    start = time.perf_counter()
+    try:
+        as_tree: ast.AST = ast.parse(source)
+        STATS["files_parsed"] += 1
+    except (SyntaxError, ValueError) as error:
+        vprint(f"Failed: {error}, cheap import scan")
+        STATS["files_scanned"] += 1
+        as_tree = cheap_import_tree(source.decode("utf-8", "replace") if type(source) is bytes else source)
+    finally:
+        STATS["parse_time"] += time.perf_counter() - start
+    return as_tree
+
+
+def find_source_dependencies(
+        source: str | bytes, virtual_path: str = "<stdin>", args: dict[str, bool] | None = None
+) -> set[str]:
+    """Find the python dependencies used in python source code (library function)
+
+    The source code is not read from a file: it can be an editor buffer. Its
+    local imports are resolved as if it was in the file `virtual_path`. The
+    directory listings used to resolve the local imports are cached between calls
+    (see `files_in_dir`), so successive calls are fast.
+
+    Parameters
+    ----------
+    source : str | bytes
+        Python source code
+    virtual_path : str
+        Path of the source code (it does not have to exist)
+    args : dict[str, bool] | None
+        The command-line arguments of this script (e.g. {"removal_policy": 1}),
+        the missing ones take their default value
+
+    Returns
+    -------
+    dependencies : set[str]
+        Set of python modules/dependencies used in the source code, filtered
+        with the removal policy
+
+    """
+
+    global DEFAULT_ARGS
+
+    if DEFAULT_ARGS is None:
+        DEFAULT_ARGS = vars(parser.parse_args([]))
+    args = {**DEFAULT_ARGS, **(args or dict())}
+    args["remove_local_imports"] = args["removal_policy"] < 2
+
+    # each call is a new scan
+    READ_FILES.clear()
+    dependencies = find_file_dependencies(
+        os.path.abspath(virtual_path), parse_python_source(source, args), args
+    )
+    if args["removal_policy"] % 2 == 0:
+        dependencies -= PYTHON_STANDARD_MODULES
+    return dependencies
+
+
+def over_budget_tree(file_path: str, content: str, reason: str, args: dict[str, bool]) -> ast.AST | None:
+    """Handle a file over a budget, using the --over-budget action
+
+    Parameters
+    ----------
+    file_path : str
+        Path of the python source code file
+    content : str
+        Python source code of the file
+    reason : str
+        Which budget is exceeded (reported in the statistics)
+    args : dict[str, bool]
+        The command-line arguments given to this script
+
+    Returns
+    -------
+    tree : ast.AST | None
+        Tree of the cheaply scanned imports, or None if the file is skipped
+
+    """
+
+    if args.get("over_budget", "scan") == "skip":
+        print(f"# WARNING: skipping file over budget ({reason}): {file_path}", file=sys.stderr)
+        OVER_BUDGET_FILES.append((file_path, f"{reason} (skipped)"))
+        STATS["files_skipped"] += 1
+        return None
+
+    vprint(f"WARNING: file over budget ({reason}), cheap import scan: {file_path}")
+    OVER_BUDGET_FILES.append((file_path, f"{reason} (scan)"))
+    STATS["files_scanned"] += 1
+    return cheap_import_tree(content)
+
+
+def scan_files(
+        input_files: Iterable[str], args: dict[str, bool], local_dependencies: set[str] | None = None
+) -> set[str]:
+    """Find the python dependencies used in python files
+
+    The files are parsed into abstract syntax trees, then searched for imports
+    (see `find_file_dependencies`).
+
+    Parameters
+    ----------
+    input_files : Iterable[str]
+        Absolute paths of the python files
+    args : dict[str, bool]
+        The command-line arguments given to this script
+    local_dependencies : set[str] | None
+        If given, the local import names are added to this set instead of the
+        returned one
+
+    Returns
+    -------
+    dependencies : set[str]
+        Set of python modules/dependencies used in the files (the stdlib modules
+        are not removed)
+
+    """
+
+    # parse the input files into abstract syntax trees
+    vprint()
+    vprint("Parsing the files ...")
+
+    start_progress("parsing", len(input_files) if hasattr(input_files, "__len__") else None)
+    file_path_tree_pairs: list[tuple[str, ast.AST]] = list()
+    for input_file in input_files:
+        vprint(f'Parsing tree for: "{input_file}"')
+        if as_tree := parse_python_file(input_file, args):
+            file_path_tree_pairs.append((input_file, as_tree))
+        advance_progress()
+
+    vprint()
+    vprint("Searching for imports ...")
+
+    # add all the dependency-sets
+    dependencies: set[str] = set()
+    num_pairs = len(file_path_tree_pairs)
+    start_progress("searching imports", num_pairs)
+    for i in range(num_pairs):
+        vprint(f"Doing AST {i + 1}/{num_pairs}")
+        file_path, as_tree = file_path_tree_pairs[i]
+        dependencies |= find_file_dependencies(file_path, as_tree, args, local_dependencies)
+        advance_progress()
+    end_progress()
+
+    return dependencies
+
+
+def file_dependencies(input_file: str, args: dict[str, bool], memo: dict[str, set[str]]) -> set[str]:
+    """Find the python dependencies used in a python file and in the local files it follows
+
+    Unlike `find_file_dependencies`, the result does not depend on the files read
+    before: it is memoized, so a file imported from everywhere is still parsed once.
+    The files of a cycle of local imports all get the same dependencies (see
+    `search_import_cycles`).
 
+    Parameters
+    ----------
+    input_file : str
+        Absolute path of the python file
+    args : dict[str, bool]
+        The command-line arguments given to this script
+    memo : dict[str, set[str]]
+        Dependencies of the files already searched
 
-def parse_python_file(file_path: str) -> ast.AST | None:
-    """Parse the input file into an AST
+    Returns
+    -------
+    file_dependencies : set[str]
+        Set of python modules/dependencies used in the python file `input_file`
 
-    Parse the python source code input file into a python
-    Abstract Syntax Tree (from ast.AST).
+    """
+
+    if input_file not in memo:
+        search_import_cycles(input_file, args, memo, dict(), list(), dict())
+    return memo[input_file]
+
+
+def search_import_cycles(
+        input_file: str,
+        args: dict[str, bool],
+        memo: dict[str, set[str]],
+        lowlinks: dict[str, int],
+        stack: list[str],
+        partial: dict[str, set[str]],
+) -> None:
+    """Search the dependencies of a file and of the local files it follows, cycle by cycle
+
+    The local imports are walked depth-first (Tarjan's strongly connected components):
+    a file which imports (transitively) a file still being searched is part of a
+    cycle, and the dependencies of the cycle are only memoized once all of its files
+    are searched.
+
+    Parameters
+    ----------
+    input_file : str
+        Absolute path of the python file
+    args : dict[str, bool]
+        The command-line arguments given to this script
+    memo : dict[str, set[str]]
+        Dependencies of the files already searched (and of their whole cycle)
+    lowlinks : dict[str, int]
+        Search order of the files visited by this search, lowered to the first file
+        of their cycle
+    stack : list[str]
+        Files visited by this search, whose cycle is not complete yet
+    partial : dict[str, set[str]]
+        Dependencies of the files of `stack`, without the ones of their cycle
+
+    """
+
+    index = lowlinks[input_file] = len(lowlinks)
+    stack.append(input_file)
+    dependencies = partial[input_file] = set()
+
+    vprint(f'Parsing tree for: "{input_file}"')
+    if as_tree := parse_python_file(input_file, args):
+        global_imports, local_import_files = search_ast_imports(
+            input_file, as_tree, os.path.dirname(input_file), args
+        )
+        dependencies |= global_imports
+        for local_import_file_path in local_import_files:
+            if not args["remove_local_imports"]:
+                dependencies.add(os.path.basename(local_import_file_path))
+            if not args["follow_local_imports"]:
+                continue
+            local_import_file_path += ".py"
+            if local_import_file_path not in memo and local_import_file_path not in lowlinks:
+                search_import_cycles(local_import_file_path, args, memo, lowlinks, stack, partial)
+            if local_import_file_path in memo:
+                dependencies |= memo[local_import_file_path]
+            else:
+                # still on the stack: same cycle
+                lowlinks[input_file] = min(lowlinks[input_file], lowlinks[local_import_file_path])
+
+    # first file of its cycle: the whole cycle is searched
+    if lowlinks[input_file] == index:
+        cycle = stack[stack.index(input_file):]
+        del stack[-len(cycle):]
+        cycle_dependencies = set().union(*(partial.pop(file_path) for file_path in cycle))
+        for file_path in cycle:
+            memo[file_path] = cycle_dependencies
+
+
+def rollup_dependencies(
+        input_files: Iterable[str], roots: Iterable[str], depth: int, args: dict[str, bool]
+) -> dict[str, set[str]]:
+    """Find the python dependencies used in each directory of the inputs
+
+    The dependencies of each file are added to its directory (or to its ancestor
+    `depth` levels below its root), then merged bottom-up into the parent directories
+    up to the root, so the whole tree is scanned once.
+
+    Parameters
+    ----------
+    input_files : Iterable[str]
+        Absolute paths of the python files
+    roots : Iterable[str]
+        Absolute paths of the input directories. The files outside of them are
+        counted in their own directory only
+    depth : int
+        Depth of the deepest directories, below the roots
+    args : dict[str, bool]
+        The command-line arguments given to this script
+
+    Returns
+    -------
+    rollup : dict[str, set[str]]
+        Set of python modules/dependencies used in each directory (the stdlib modules
+        are not removed)
+
+    """
+
+    # deepest roots first, so the files are counted in the closest one
+    roots = sorted(set(roots), key=len, reverse=True)
+    memo: dict[str, set[str]] = dict()
+    rollup: dict[str, set[str]] = dict()
+    parents: dict[str, str] = dict()
+
+    start_progress("scanning", len(input_files) if hasattr(input_files, "__len__") else None)
+    for input_file in input_files:
+        dependencies = file_dependencies(input_file, args, memo)
+        advance_progress()
+        dir_path = os.path.dirname(input_file)
+        root = next((root for root in roots if dir_path == root or dir_path.startswith(root + os.sep)), dir_path)
+        parts = os.path.relpath(dir_path, root).split(os.sep)[:depth] if dir_path != root else []
+        dir_path = root
+        for part in parts:
+            parents[os.path.join(dir_path, part)] = dir_path
+            dir_path = os.path.join(dir_path, part)
+        rollup.setdefault(dir_path, set()).update(dependencies)
+    end_progress()
+
+    # merge the subdirectories into their parents, deepest first
+    for dir_path in sorted(parents, key=lambda path: path.count(os.sep), reverse=True):
+        rollup.setdefault(parents[dir_path], set()).update(rollup.setdefault(dir_path, set()))
+
+    return rollup
+
+
+def find_contained_modules(
+        input_files: Iterable[str], names: set[str], find_all: bool, args: dict[str, bool]
+) -> set[str]:
+    """Search the files one by one for the given modules, stopping once they are found
+
+    Each file is parsed and searched before the next one is read, so no work is
+    done past the file importing the (last) wanted module. The files importing the
+    modules are printed as they are found.
+
+    Parameters
+    ----------
+    input_files : Iterable[str]
+        Absolute paths of the python files
+    names : set[str]
+        Names of the wanted modules. Their submodules match too
+    find_all : bool
+        Only stop once all the modules are found, instead of the first one
+    args : dict[str, bool]
+        The command-line arguments given to this script
+
+    Returns
+    -------
+    found_names : set[str]
+        Names of the wanted modules that were found
+
+    """
+
+    found_names: set[str] = set()
+    memo: dict[str, set[str]] = dict()
+
+    start_progress("searching", len(input_files) if hasattr(input_files, "__len__") else None)
+    for input_file in input_files:
+        advance_progress()
+        dependencies = file_dependencies(input_file, args, memo)
+        for name in sorted(names - found_names):
+            if any(dep == name or dep.startswith(name + ".") for dep in dependencies):
+                # erase the progress line, it is printed again on the next file
+                if PROGRESS is not None:
+                    sys.stderr.write("\r\033[K")
+                print(f"{os.path.relpath(input_file)}: {name}")
+                found_names.add(name)
+        if found_names and (not find_all or found_names == names):
+            break
+    end_progress()
+
+    return found_names
+
+
+def git(*git_args: str) -> bytes:
+    """Run a git command and return its output
+
+    Raises
+    ------
+    ArgumentError
+        The git command failed (e.g. unknown revision, not in a git repository)
+
+    """
+
+    try:
+        return subprocess.run(["git", *git_args], check=True, capture_output=True).stdout
+    except (OSError, subprocess.CalledProcessError) as error:
+        stderr = getattr(error, "stderr", b"") or b""
+        raise ArgumentError(f"git {' '.join(git_args)} failed: {stderr.decode(errors='replace').strip() or error}")
+
+
+def open_git_revision(rev: str) -> None:
+    """Scan a revision of the local git repository instead of the filesystem
+
+    The tree of the revision is listed once (`git ls-tree`), and used to resolve
+    the local imports (see `path_is_file`, `path_is_dir`, `files_in_dir`). The
+    contents of the files are streamed through a single long-lived
+    `git cat-file --batch` process (see `read_git_blob`). The paths of the files
+    are the paths they would have in the working tree.
+
+    Parameters
+    ----------
+    rev : str
+        Git revision (e.g. "v1.2.0", "HEAD~3", a commit hash)
+
+    """
+
+    global GIT_FILES, GIT_DIRS, GIT_CAT_FILE
+
+    close_git_revision()
+    root = os.path.abspath(git("rev-parse", "--show-toplevel").decode().strip())
+    git_files, git_dirs = dict(), {root: []}
+    for entry in git("-C", root, "ls-tree", "-r", "-z", "--full-tree", rev).split(b"\0"):
+        if not entry:
+            continue
+        info, _, rel_path = entry.partition(b"\t")
+        mode, object_type, object_name = info.split()
+        # regular files only (no symlinks, no submodules)
+        if object_type != b"blob" or mode == b"120000":
+            continue
+        file_path = os.path.join(root, *os.fsdecode(rel_path).split("/"))
+        git_files[file_path] = object_name.decode()
+        dir_path = os.path.dirname(file_path)
+        git_dirs.setdefault(dir_path, []).append(file_path)
+        # register the parent directories
+        while dir_path != root and (parent := os.path.dirname(dir_path)) not in git_dirs:
+            git_dirs[parent] = []
+            dir_path = parent
+    vprint(f"git revision {rev}: {len(git_files)} files")
+
+    GIT_FILES, GIT_DIRS = git_files, git_dirs
+    GIT_CAT_FILE = subprocess.Popen(
+        ["git", "-C", root, "cat-file", "--batch"], stdin=subprocess.PIPE, stdout=subprocess.PIPE
+    )
+
+
+def close_git_revision() -> None:
+    """Go back to scanning the filesystem (see `open_git_revision`)"""
+
+    global GIT_FILES, GIT_DIRS, GIT_CAT_FILE
+
+    if GIT_CAT_FILE is not None:
+        GIT_CAT_FILE.stdin.close()
+        GIT_CAT_FILE.wait()
+    GIT_FILES, GIT_DIRS, GIT_CAT_FILE = None, dict(), None
+
+
+def read_git_blob(file_path: str) -> bytes:
+    """Read the content of a file of the scanned git revision
 
     Parameters
     ----------
     file_path : str
-        Path of the python source code file
+        Path of the file (in the working tree)
 
     Returns
     -------
-    tree : ast.AST
-        Abstract Syntax Tree of the python file `file_path`
+    content : bytes
+        Content of the file in the scanned revision
 
     """
 
-    if not os.path.isfile(file_path):
-        vprint(f"WARNING: input file does not exist: {file_path}")
-        return None
+    GIT_CAT_FILE.stdin.write(GIT_FILES[file_path].encode() + b"\n")
+    GIT_CAT_FILE.stdin.flush()
+    # header: "<object name> <type> <size>", then the content and a newline
+    size = int(GIT_CAT_FILE.stdout.readline().split()[2])
+    return GIT_CAT_FILE.stdout.read(size + 1)[:-1]
 
-    with open(file_path, "r") as file:
-        try:
-            content = file.read()
-        except UnicodeDecodeError:
-            return None
-        try:
-            as_tree: ast.AST = ast.parse(content)
-        except SyntaxError as se:
-            vprint(f"Failed: {se}")
-            return None
 
-    return as_tree
+def git_input_files(input_paths: Iterable[str], dir_scanning_expr: str) -> list[str]:
+    """Get the input files in the scanned git revision (see `discover_input_files`)
+
+    Parameters
+    ----------
+    input_paths : Iterable[str]
+        Input files and/or directories
+    dir_scanning_expr : str
+        Only the files matching this expression are kept in the scanned directories
 
+    Returns
+    -------
+    input_files : list[str]
+        Absolute paths of the input files
 
-# - Main function -
-def run(args: dict[str, bool | AnyStr | Iterable[AnyStr]]) -> None:
-    global DEPENDENCIES, USAGE_MSG, ROOT_DIR, PYTHON_STANDARD_MODULES, vprint
+    Raises
+    ------
+    OSError
+        One of the inputs is not in the revision
 
-    # assert input was given
-    if not args["input"]:
-        raise ArgumentError(f'Missing argument "input" (-i/--input). {USAGE_MSG}')
+    """
 
-    # validate removal policy
-    if args["removal_policy"] < 0 or args["removal_policy"] > 3:
-        raise ArgumentError(
-            f'Invalid removal policy: {args["removal_policy"]}. {USAGE_MSG}'
-        )
+    input_files = list()
+    for abs_path in map(os.path.abspath, input_paths):
+        if abs_path in GIT_FILES:
+            input_files.append(abs_path)
+        elif abs_path in GIT_DIRS:
+            input_files.extend(
+                file_path for file_path in GIT_FILES
+                if file_path.startswith(os.path.join(abs_path, ""))
+                and fnmatch.fnmatch(os.path.basename(file_path), dir_scanning_expr)
+            )
+        else:
+            raise OSError(f'Input path: "{abs_path}" does not exist in the git revision')
+    return sorted(input_files)
 
-    # setup args missing values
-    args["remove_local_imports"] = args["removal_policy"] < 2
+
+def git_revision_dependencies(rev: str, args: dict[str, bool]) -> set[str]:
+    """Find the python dependencies used in the input files of a git revision
+
+    Parameters
+    ----------
+    rev : str
+        Git revision
+    args : dict[str, bool]
+        The command-line arguments given to this script
+
+    Returns
+    -------
+    dependencies : set[str]
+        Set of python modules/dependencies, filtered with the removal policy
+
+    """
+
+    vprint()
+    vprint(f"Scanning the git revision {rev} ...")
+    open_git_revision(rev)
+    try:
+        READ_FILES.clear()
+        input_files = git_input_files(args["input"] or [os.curdir], args["dir_scanning_expr"])
+        dependencies = scan_files(input_files, args)
+    finally:
+        close_git_revision()
+    if args["removal_policy"] % 2 == 0:
+        dependencies -= PYTHON_STANDARD_MODULES
+    return dependencies
+
+
+def read_file_list(list_path: str, dir_scanning_expr: str) -> Iterable[str]:
+    """Read a list of input files, as a stream
+
+    The list is read by chunks, and the paths are yielded as soon as they are read,
+    so the parsing of the files starts right away. The paths are separated by NUL
+    characters (e.g. "git ls-files -z", "find -print0") or, if there are none in the
+    first chunk, by newlines. No directory is scanned and the files are not checked
+    (no stat): missing files are reported when they are opened.
+
+    Parameters
+    ----------
+    list_path : str
+        Path of the file list ("-" for stdin)
+    dir_scanning_expr : str
+        Only the files whose name matches this expression are kept
+
+    Returns
+    -------
+    input_files : Iterable[str]
+        Absolute paths of the input files
+
+    """
+
+    file = sys.stdin.buffer if list_path == "-" else open(list_path, "rb")
+    try:
+        separator: bytes | None = None
+        remainder = b""
+        while chunk := file.read(FILE_LIST_CHUNK_SIZE):
+            if separator is None:
+                separator = b"\0" if b"\0" in chunk else b"\n"
+            *paths, remainder = (remainder + chunk).split(separator)
+            yield from filter_file_list(paths, dir_scanning_expr)
+        yield from filter_file_list([remainder], dir_scanning_expr)
+    finally:
+        if file is not sys.stdin.buffer:
+            file.close()
+
+
+def filter_file_list(paths: list[bytes], dir_scanning_expr: str) -> Iterable[str]:
+    """Decode the paths of a file list, keeping the ones matching `dir_scanning_expr`"""
+
+    for path in map(os.fsdecode, paths):
+        path = path.rstrip("\r")
+        if path and fnmatch.fnmatch(os.path.basename(path), dir_scanning_expr):
+            yield os.path.abspath(path)
+
+
+def enable_verbose(args: dict[str, bool | AnyStr | Iterable[AnyStr]]) -> None:
+    """Set up the verbose print function (all messages prepended with '#')"""
+
+    global vprint
+
+    vprint = lambda *a, **k: print("#", *a, **k)
+
+    vprint()
+    vprint("verbose mode")
+    vprint(f"args: {args}")
+
+
+def discover_input_files(input_paths: Iterable[str], dir_scanning_expr: str) -> list[str]:
+    """Get the input files, scanning the input directories
+
+    Parameters
+    ----------
+    input_paths : Iterable[str]
+        Input files and/or directories
+    dir_scanning_expr : str
+        Only the files matching this expression are kept in the scanned directories
+
+    Returns
+    -------
+    input_files : list[str]
+        Absolute paths of the input files
+
+    Raises
+    ------
+    OSError
+        One of the inputs is missing, or is neither a file, nor a directory
+
+    """
 
     # init files & directories
     input_files = list()
     input_directories = list()
 
     # evaluate the paths & check their existence
-    for rel_path in args["input"]:
+    for rel_path in input_paths:
         abs_path = os.path.abspath(rel_path)
         if not os.path.exists(abs_path):
             raise OSError(f'Input path: "{abs_path}" does not exist')
@@ -910,62 +3598,337 @@ def run(args: dict[str, bool | AnyStr | Iterable[AnyStr]]) -> None:
     # scan the folders
     for folder in input_directories:
         for path, _, files in os.walk(folder):
-            filtered_files = fnmatch.filter(files, args["dir_scanning_expr"])
+            filtered_files = fnmatch.filter(files, dir_scanning_expr)
             input_files.extend(map(lambda fn: os.path.join(path, fn), filtered_files))
 
+    return input_files
+
+
+# - Main function -
+def run(args: dict[str, bool | AnyStr | Iterable[AnyStr]]) -> None:
+    global DEPENDENCIES, USAGE_MSG, ROOT_DIR, PYTHON_STANDARD_MODULES, HEADER
+
+    # assert input was given
+    if not args["input"] and not args["stdin"] and not args["git_rev"] and not args["files_from"]:
+        raise ArgumentError(f'Missing argument "input" (-i/--input), --files-from or --stdin. {USAGE_MSG}')
+    if args["stdin"] and args["files_from"] == "-":
+        raise ArgumentError(f'--stdin and "--files-from -" can\'t be used together. {USAGE_MSG}')
+    if args["git_rev"] and len(args["git_rev"]) > 2:
+        raise ArgumentError(f"--git-rev can be given at most twice. {USAGE_MSG}")
+    if args["rollup"] is not None and (args["rollup"] < 0 or args["shard"] or args["stdin"]):
+        raise ArgumentError(
+            f"--rollup needs a depth of 0 or more, and can't be used with --shard or --stdin. {USAGE_MSG}"
+        )
+    if args["contains"] and (args["shard"] or args["rollup"] is not None or args["stdin"]):
+        raise ArgumentError(f"--contains can't be used with --shard, --rollup or --stdin. {USAGE_MSG}")
+
+    # validate removal policy
+    if args["removal_policy"] < 0 or args["removal_policy"] > 3:
+        raise ArgumentError(
+            f'Invalid removal policy: {args["removal_policy"]}. {USAGE_MSG}'
+        )
+
+    # setup args missing values (the removal policy of a shard is only applied at merge time)
+    args["remove_local_imports"] = args["removal_policy"] < 2 and not args["shard"]
+
     # print the header if asked for (default behaviour)
-    if args["header"]:
-        global HEADER
+    if args["header"] and not args["shard"] and not args["affected_by"] and not args["contains"]:
         print(HEADER)
 
     # setup verbose print function
     if args["verbose"]:
-        vprint = lambda *a, **k: print("#", *a, **k)
+        enable_verbose(args)
 
-        vprint()
-        vprint("verbose mode")
-        vprint(f"args: {args}")
-
-    # parse the input files into abstract syntax trees
-    vprint()
-    vprint("Parsing the files ...")
-
-    file_path_tree_pairs: list[tuple[str, ast.AST]] = list()
-    for input_file in input_files:
-        vprint(f'Parsing tree for: "{input_file}"')
-        if as_tree := parse_python_file(input_file):
-            file_path_tree_pairs.append((input_file, as_tree))
+    # show the progress on stderr (by default, only if it is a terminal)
+    global SHOW_PROGRESS
+    SHOW_PROGRESS = sys.stderr.isatty() if args["progress"] is None else args["progress"]
 
-    vprint()
-    vprint("Searching for imports ...")
+    # compare the dependencies of two git revisions ?
+    if args["git_rev"] and len(args["git_rev"]) == 2:
+        old_dependencies, new_dependencies = (
+            git_revision_dependencies(rev, args) for rev in args["git_rev"]
+        )
+        for dep in sorted(old_dependencies ^ new_dependencies):
+            print(f"{'+' if dep in new_dependencies else '-'}{dep}")
+        if args["stats"]:
+            print_stats()
+        sys.exit(0)
+
+    try:
+        # find the input files
+        if args["git_rev"]:
+            open_git_revision(args["git_rev"][0])
+            input_files = git_input_files(args["input"] or [os.curdir], args["dir_scanning_expr"])
+        else:
+            input_files = discover_input_files(args["input"] or [], args["dir_scanning_expr"])
+
+        # stream the files of the given list straight into parsing
+        if args["files_from"]:
+            input_files = itertools.chain(input_files, read_file_list(args["files_from"], args["dir_scanning_expr"]))
+
+        # only keep the files of our shard
+        if args["shard"]:
+            input_files = (input_file for input_file in input_files if file_in_shard(input_file, *args["shard"]))
+
+        # affected files instead of the dependencies ?
+        if args["affected_by"]:
+            vprint()
+            vprint("Building the reverse local-import graph ...")
+            input_files = list(input_files)
+            importers = reverse_local_import_graph(input_files, args)
+            for file_path in sorted(affected_files(args["affected_by"], importers, input_files)):
+                print(os.path.relpath(file_path))
+            if args["stats"]:
+                print_stats()
+            sys.exit(0)
+
+        # only tell if some modules are imported ?
+        if args["contains"]:
+            vprint()
+            vprint(f"Searching for: {', '.join(sorted(args['contains']))}")
+            found_names = find_contained_modules(input_files, args["contains"], args["contains_all"], args)
+            if args["stats"]:
+                print_stats()
+            sys.exit(0 if found_names and (not args["contains_all"] or found_names == args["contains"]) else 1)
+
+        # parse the input files and search for imports (per directory ?)
+        rollup: dict[str, set[str]] = dict()
+        if args["rollup"] is not None:
+            roots = [os.path.abspath(path) for path in args["input"] or [os.curdir]]
+            roots = [root for root in roots if (root in GIT_DIRS if args["git_rev"] else os.path.isdir(root))]
+            rollup = rollup_dependencies(input_files, roots, args["rollup"], args)
+            DEPENDENCIES.update(*rollup.values())
+        else:
+            DEPENDENCIES |= scan_files(input_files, args, LOCAL_DEPENDENCIES if args["shard"] else None)
+
+        # source code given on stdin (e.g. editor buffer)
+        if args["stdin"]:
+            vprint(f'Parsing tree for stdin: "{args["stdin_path"]}"')
+            DEPENDENCIES |= find_file_dependencies(
+                os.path.abspath(args["stdin_path"]),
+                parse_python_source(sys.stdin.read(), args),
+                args,
+                LOCAL_DEPENDENCIES if args["shard"] else None,
+            )
+    finally:
+        # stop the git cat-file process of the scanned revision, if any
+        close_git_revision()
 
-    # add all the dependency-sets
-    num_pairs = len(file_path_tree_pairs)
-    for i in range(num_pairs):
-        vprint(f"Doing AST {i + 1}/{num_pairs}")
-        file_path, as_tree = file_path_tree_pairs[i]
-        DEPENDENCIES |= find_file_dependencies(file_path, as_tree, args)
+    # partial result: the removal policy is applied by "findpydeps merge"
+    if args["shard"]:
+        vprint()
+        vprint(f"Done. Writing the partial result to {args['shard_output']}")
+        write_partial(args["shard_output"], DEPENDENCIES, LOCAL_DEPENDENCIES, args)
+        if args["stats"]:
+            print_stats()
+        sys.exit(0)
 
     # remove the python stdlib dependencies ?
     if args["removal_policy"] % 2 == 0:
         vprint("Removing imports from the python stdlib")
         global PYTHON_STANDARD_MODULES
         DEPENDENCIES -= PYTHON_STANDARD_MODULES
+        for dir_dependencies in rollup.values():
+            dir_dependencies -= PYTHON_STANDARD_MODULES
+
+    # check the dependencies against the current environment ?
+    missing: set[str] = set()
+    if args["check_installed"]:
+        vprint("Checking the installed dependencies")
+        missing = missing_installed_dependencies(DEPENDENCIES)
+
+    # import costs of the dependencies ?
+    costs: dict[str, tuple[int, int] | None] = dict()
+    if args["import_cost"]:
+        vprint("Measuring the import costs")
+        costs = import_costs(DEPENDENCIES, args["import_cost_workers"])
+
+    # installed distributions and their requirements ?
+    if args["transitive"]:
+        vprint("Following the requirements of the installed distributions")
+        DEPENDENCIES = transitive_dependencies(DEPENDENCIES)
+        rollup = {dir_path: transitive_dependencies(deps) for dir_path, deps in rollup.items()}
 
     # finally output the content of the dependencies
     vprint()
     vprint("Done. Printing the module names")
 
-    for dep in list(DEPENDENCIES):
+    if args["rollup"] is None:
+        for dep in sorted(DEPENDENCIES):
+            print(dep)
+    for dir_path in sorted(rollup):
+        print(f"# {os.path.relpath(dir_path)}")
+        for dep in sorted(rollup[dir_path]):
+            print(dep)
+
+    for dep in sorted(missing):
+        print(f"# missing installed dependency: {dep}")
+    exit_code = 1 if missing else 0
+
+    if costs:
+        print("# import cost (cumulative time, modules): heaviest first")
+    for dep, cost in sorted(costs.items(), key=lambda dep_cost: (-(dep_cost[1] or (-1,))[0], dep_cost[0])):
+        if cost is None:
+            print(f"# {'failed':>10}            {dep}")
+        elif cost == (0, 0):
+            print(f"# {'preloaded':>10}            {dep}")
+        else:
+            print(f"# {cost[0] / 1000:>8.1f}ms {cost[1]:>5} modules {dep}")
+
+    for input_file, lineno, module_name, bound_name in sorted(LAZY_IMPORTS):
+        print(f"# {os.path.relpath(input_file)}:{lineno}: {module_name} ({bound_name}) is only used inside functions")
+
+    if args["stats"]:
+        print_stats()
+
+    sys.exit(exit_code)
+
+
+def run_merge(args: dict[str, bool | AnyStr | Iterable[AnyStr]]) -> None:
+    """Merge the partial results of sharded scans (`findpydeps merge`)
+
+    The partials are combined into the dependency set of a single-node scan:
+    the global dependencies of all the shards are merged, the local imports are
+    added unless removed by the policy, and the stdlib modules are removed last,
+    exactly as `run` would have done.
+
+    Raises
+    ------
+    ArgumentError
+        Invalid removal policy || the partials come from scans with different
+        options or do not cover every shard exactly once
+
+    """
+
+    global USAGE_MSG, PYTHON_STANDARD_MODULES
+
+    # validate removal policy
+    if args["removal_policy"] < 0 or args["removal_policy"] > 3:
+        raise ArgumentError(
+            f'Invalid removal policy: {args["removal_policy"]}. {USAGE_MSG}'
+        )
+
+    global_dependencies: set[str] = set()
+    local_dependencies: set[str] = set()
+    options: dict[str, bool] | None = None
+    num_shards: int | None = None
+    seen_shards: set[int] = set()
+
+    for partial_path in args["partials"]:
+        partial = read_partial(partial_path)
+        index, count = partial["shard"]
+        if options is None:
+            options, num_shards = partial["options"], count
+        elif partial["options"] != options or count != num_shards:
+            raise ArgumentError(f'Partial "{partial_path}" comes from a scan with different options')
+        if index in seen_shards:
+            raise ArgumentError(f'Shard {index}/{count} was given more than once ("{partial_path}")')
+        seen_shards.add(index)
+        global_dependencies |= set(partial["dependencies"])
+        local_dependencies |= set(partial["local"])
+
+    missing_shards = set(range(1, num_shards + 1)) - seen_shards
+    if missing_shards:
+        raise ArgumentError(
+            f"Missing partials for the shards: {', '.join(f'{i}/{num_shards}' for i in sorted(missing_shards))}"
+        )
+
+    # same order as in `run`: local imports first, then the stdlib removal
+    if args["removal_policy"] >= 2:
+        global_dependencies |= local_dependencies
+    if args["removal_policy"] % 2 == 0:
+        global_dependencies -= PYTHON_STANDARD_MODULES
+
+    if args["header"]:
+        global HEADER
+        print(HEADER)
+
+    for dep in sorted(global_dependencies):
         print(dep)
 
     sys.exit(0)
 
 
+def run_index(args: dict[str, bool | AnyStr | Iterable[AnyStr]]) -> None:
+    """Update or query the persistent import index (`findpydeps index`)
+
+    Without a query, the input files are (re-)indexed (see `update_index`).
+    The queries only read the index tables, no file is parsed:
+     * who-imports: the files importing the given modules
+     * deps: the dependencies of the files in the given directories, using
+       the removal policy
+
+    Raises
+    ------
+    ArgumentError
+        No input and no query given || Invalid removal policy
+
+    """
+
+    global USAGE_MSG, PYTHON_STANDARD_MODULES
+
+    if args["verbose"]:
+        enable_verbose(args)
+
+    if not args["query"] and not args["input"]:
+        raise ArgumentError('Missing argument "input" (-i/--input) or query. Try "findpydeps index -h" to get help.')
+
+    with open_index(args["db"]) as connection:
+        # update the index
+        if args["input"]:
+            input_files = discover_input_files(args["input"] or [], args["dir_scanning_expr"])
+            roots = [os.path.abspath(path) for path in args["input"]]
+            num_files, num_updated, num_removed = update_index(connection, input_files, roots, args)
+            print(f"# {args['db']}: {num_files} files, {num_updated} (re-)indexed, {num_removed} removed")
+
+        # reverse lookup of the modules (prefixes compared with substr: LIKE has wildcards and ignores the case)
+        if args["query"] == "who-imports":
+            rows = connection.execute(
+                f"SELECT DISTINCT path FROM imports WHERE "
+                f"{' OR '.join('module = ? OR substr(module, 1, ?) = ?' for _ in args['modules'])} ORDER BY path",
+                [value for module in args["modules"] for value in (module, len(module) + 1, module + ".")],
+            )
+            for (path,) in rows:
+                print(os.path.relpath(path))
+
+        # dependencies of directories
+        elif args["query"] == "deps":
+            if args["removal_policy"] < 0 or args["removal_policy"] > 3:
+                raise ArgumentError(
+                    f'Invalid removal policy: {args["removal_policy"]}. {USAGE_MSG}'
+                )
+            dependencies: set[str] = set()
+            for path in map(os.path.abspath, args["paths"]):
+                where = "path = ? OR substr(path, 1, ?) = ?"
+                values = (path, len(os.path.join(path, "")), os.path.join(path, ""))
+                dependencies.update(
+                    module for (module,) in connection.execute(f"SELECT module FROM imports WHERE {where}", values)
+                )
+                if args["removal_policy"] >= 2:
+                    dependencies.update(
+                        local_import_name(target) for (target,) in
+                        connection.execute(f"SELECT target FROM local_edges WHERE {where}", values)
+                    )
+            if args["removal_policy"] % 2 == 0:
+                dependencies -= PYTHON_STANDARD_MODULES
+            for dep in sorted(dependencies):
+                print(dep)
+
+    sys.exit(0)
+
+
+# sub-commands of the command line interface (e.g. "findpydeps merge ...")
+SUBCOMMANDS: dict[str, tuple[ArgumentParser, Callable]] = {
+    "merge": (merge_parser, run_merge),
+    "index": (index_parser, run_index),
+}
+
+
 def main() -> None:
     """Main function for the findpydeps script
 
     Those are the steps by this function :
+     * Dispatch to a sub-command (e.g. `findpydeps merge`), if one is given
      * Parse and validate the command line arguments
      * Scan the directories that were given, if any
      * Print the header, unless asked not to
@@ -991,6 +3954,11 @@ def main() -> None:
         parser.print_help(sys.stderr)
         sys.exit(1)
 
+    # sub-command ?
+    if sys.argv[1] in SUBCOMMANDS:
+        sub_parser, sub_run = SUBCOMMANDS[sys.argv[1]]
+        sub_run(vars(sub_parser.parse_args(sys.argv[2:])))
+
     # parse the command line arguments
     args = vars(parser.parse_args())
 
@@ -1,8 +1,18 @@
 import unittest
 import sys
 import io
+import os
+import dis
+import py_compile
+import re
+import shutil
+import subprocess
+import tempfile
+from contextlib import redirect_stdout
+from unittest import mock
 
 import findpydeps
+from findpydeps import findpydeps as fpd
 
 
 class MyTestCase(unittest.TestCase):
@@ -17,5 +27,630 @@ class MyTestCase(unittest.TestCase):
         self.assertEqual(output.getvalue(), expected)
 
 
+SAMPLE_SOURCE = """
+\"\"\"docstring\"\"\"
+import os, sys as system
+import numpy.random as rd
+from collections import OrderedDict
+from . import sibling
+from .sibling import thing
+from .. import *
+try:
+    import ujson as json
+except ImportError:
+    import json
+with open(__file__) as f:
+    import yaml
+
+
+def function():
+    import pandas
+    from requests.adapters import HTTPAdapter
+
+    def nested():
+        import toml
+
+
+async def coroutine():
+    import aiohttp
+
+
+class Class:
+    import attr
+
+    def method(self):
+        from scipy import stats
+"""
+
+
+class BytecodeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.file_path = os.path.join(self.tmp_dir.name, "sample.py")
+        with open(self.file_path, "w") as f:
+            f.write(SAMPLE_SOURCE)
+        with open(os.path.join(self.tmp_dir.name, "sibling.py"), "w") as f:
+            f.write("thing = 1\n")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def imports(self, **options):
+        args = vars(findpydeps.parser.parse_args(["-i", self.file_path]))
+        args.update(options)
+        tree = fpd.parse_python_file(self.file_path, args)
+        return fpd.handle_ast_object(tree, self.tmp_dir.name, args)
+
+    def assert_same_as_source(self, invalidation_mode, **options):
+        py_compile.compile(self.file_path, invalidation_mode=invalidation_mode, doraise=True)
+        read_from_bytecode = fpd.STATS["files_from_bytecode"]
+        self.assertEqual(self.imports(bytecode=True, **options), self.imports(bytecode=False, **options))
+        self.assertEqual(fpd.STATS["files_from_bytecode"], read_from_bytecode + 1)
+
+    def test_timestamp_bytecode(self):
+        self.assert_same_as_source(py_compile.PycInvalidationMode.TIMESTAMP)
+
+    def test_hash_bytecode(self):
+        self.assert_same_as_source(py_compile.PycInvalidationMode.CHECKED_HASH)
+
+    def test_no_functions(self):
+        self.assert_same_as_source(py_compile.PycInvalidationMode.TIMESTAMP, functions=False)
+
+    def test_submodules(self):
+        self.assert_same_as_source(py_compile.PycInvalidationMode.TIMESTAMP, submodules=True)
+
+    def test_stale_bytecode(self):
+        py_compile.compile(self.file_path, doraise=True)
+        with open(self.file_path, "a") as f:
+            f.write("import stale\n")
+        self.assertIsNone(fpd.bytecode_import_tree(self.file_path, {}))
+        self.assertIn("stale", self.imports(bytecode=True)[0])
+
+    def test_missing_bytecode(self):
+        self.assertIsNone(fpd.bytecode_import_tree(self.file_path, {}))
+
+    def test_level_not_loaded_by_load_const(self):
+        # e.g. python 3.14 loads the small ints with LOAD_SMALL_INT
+        get_instructions = dis.get_instructions
+
+        def small_int_instructions(code):
+            for instruction in get_instructions(code):
+                if instruction.opname == "LOAD_CONST" and type(instruction.argval) is int:
+                    instruction = instruction._replace(opname="LOAD_SMALL_INT")
+                yield instruction
+
+        code = compile("from .sibling import thing\nfrom .. import *\nimport os\n", self.file_path, "exec")
+        with mock.patch.object(fpd.dis, "get_instructions", small_int_instructions):
+            imports = fpd.imports_from_code_object(code)
+        self.assertEqual(
+            [(type(node), getattr(node, "module", None), getattr(node, "level", 0)) for node in imports],
+            [(fpd.ast.ImportFrom, "sibling", 1), (fpd.ast.ImportFrom, None, 2), (fpd.ast.Import, None, 0)],
+        )
+
+
+class HeaderOnlyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.file_path = os.path.join(self.tmp_dir.name, "module.py")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def header_imports(self, source):
+        with open(self.file_path, "w") as f:
+            f.write(source)
+        args = vars(findpydeps.parser.parse_args(["-i", self.file_path, "--header-only"]))
+        tree = fpd.parse_python_file(self.file_path, args)
+        return fpd.handle_ast_object(tree, self.tmp_dir.name, args)[0]
+
+    def test_statement_on_an_import_line(self):
+        self.assertEqual(self.header_imports("import a; x = 1\nimport b\n"), {"a"})
+
+    def test_main_block(self):
+        source = 'import a\nif __name__ == "__main__":\n    import c\n    main()\nimport b\n'
+        self.assertEqual(self.header_imports(source), {"a"})
+
+    def test_fallback_assignment(self):
+        source = "try:\n    import ujson as json\nexcept ImportError:\n    json = None\nimport b\n"
+        self.assertEqual(self.header_imports(source), {"ujson", "b"})
+
+    def test_guard_with_a_call(self):
+        source = "import a\ntry:\n    import c\n    setup()\nexcept ImportError:\n    pass\nimport b\n"
+        self.assertEqual(self.header_imports(source), {"a"})
+
+    def test_rest_of_the_file_not_read(self):
+        rest = "def function():\n    import c\n" * 1000
+        bytes_skipped = fpd.STATS["bytes_skipped"]
+        self.assertEqual(self.header_imports("import a\nx = 1\n" + rest), {"a"})
+        self.assertEqual(fpd.STATS["bytes_skipped"] - bytes_skipped, len(rest))
+
+
+def run_output(run, parser, arguments):
+    """Run findpydeps in-process, returning its exit status and the lines it printed"""
+
+    args = vars(parser.parse_args(arguments))
+    with mock.patch.multiple(fpd, DEPENDENCIES=set(), LOCAL_DEPENDENCIES=set(), READ_FILES=set(), LAZY_IMPORTS=[]):
+        with redirect_stdout(io.StringIO()) as output:
+            try:
+                run(args)
+            except SystemExit as exit_status:
+                status = exit_status.code
+            else:
+                status = None
+    return status, output.getvalue().splitlines()
+
+
+def write_tree(root, tree):
+    for file_path, source in tree.items():
+        file_path = os.path.join(root, file_path)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, "w") as f:
+            f.write(source)
+
+
+SHARD_TREE = {
+    "main.py": "import os\nimport requests\nimport helper\nfrom pkg import sub\n",
+    "helper.py": "import json\nimport yaml\n",
+    "pkg/__init__.py": "",
+    "pkg/sub.py": "import numpy\nfrom . import other\n",
+    "pkg/other.py": "import toml\nimport sys\n",
+    "scripts/tool.py": "import click\nimport helper\n",
+}
+
+
+class ShardTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        write_tree(self.tmp_dir.name, SHARD_TREE)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def output_of(self, run, parser, arguments):
+        status, lines = run_output(run, parser, arguments)
+        self.assertEqual(status, 0)
+        return lines
+
+    def test_merge_matches_single_node(self):
+        for options in ([], ["-l"]):
+            for count in (1, 2, 3):
+                partials = list()
+                for index in range(1, count + 1):
+                    partials.append(os.path.join(self.tmp_dir.name, f"partial-{index}.json"))
+                    self.output_of(fpd.run, findpydeps.parser, [
+                        "-i", self.tmp_dir.name, "--no-header", "--no-progress", *options,
+                        "--shard", f"{index}/{count}", "--shard-output", partials[-1],
+                    ])
+                for policy in ("0", "1", "2", "3"):
+                    with self.subTest(options=options, count=count, policy=policy):
+                        self.assertEqual(
+                            self.output_of(fpd.run_merge, fpd.merge_parser, [*partials, "-r", policy, "--no-header"]),
+                            self.output_of(fpd.run, findpydeps.parser, [
+                                "-i", self.tmp_dir.name, "--no-header", "--no-progress", *options, "-r", policy,
+                            ]),
+                        )
+
+    def test_incompatible_partials(self):
+        partials = list()
+        for index, options in ((1, []), (2, ["--header-only"])):
+            partials.append(os.path.join(self.tmp_dir.name, f"partial-{index}.json"))
+            self.output_of(fpd.run, findpydeps.parser, [
+                "-i", self.tmp_dir.name, "--no-progress", *options,
+                "--shard", f"{index}/2", "--shard-output", partials[-1],
+            ])
+        with self.assertRaises(fpd.ArgumentError):
+            fpd.run_merge(vars(fpd.merge_parser.parse_args(partials)))
+
+
+AFFECTED_TREE = {
+    "app.py": "from pkg import api\n",
+    "cli.py": "import requests\n",
+    "pkg/__init__.py": "",
+    "pkg/api.py": "from . import models\n",
+    "pkg/models.py": "import sqlalchemy\n",
+}
+
+
+class AffectedByTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.root = self.tmp_dir.name
+        write_tree(self.root, AFFECTED_TREE)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def affected(self, changed_files, inputs=(".",)):
+        status, lines = run_output(fpd.run, findpydeps.parser, [
+            "-i", *(os.path.join(self.root, path) for path in inputs), "--no-progress",
+            "--affected-by", *(os.path.join(self.root, path) for path in changed_files),
+        ])
+        self.assertEqual(status, 0)
+        return set(os.path.relpath(os.path.abspath(path), self.root) for path in lines)
+
+    def test_transitive_importers(self):
+        self.assertEqual(
+            self.affected(["pkg/models.py"]),
+            {"app.py", os.path.join("pkg", "api.py"), os.path.join("pkg", "models.py")},
+        )
+
+    def test_package_init(self):
+        self.assertEqual(
+            self.affected(["pkg/__init__.py"]),
+            {"app.py", os.path.join("pkg", "api.py"), os.path.join("pkg", "__init__.py")},
+        )
+
+    def test_changed_files_out_of_the_inputs(self):
+        self.assertEqual(
+            self.affected(["pkg/models.py", "cli.py"], inputs=("app.py", "pkg/api.py")),
+            {"app.py", os.path.join("pkg", "api.py")},
+        )
+
+
+@unittest.skipUnless(shutil.which("git"), "git is not installed")
+class GitRevisionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.root = os.path.realpath(self.tmp_dir.name)
+        write_tree(self.root, {"main.py": "import requests\nfrom pkg import helper\n", "pkg/helper.py": "import yaml\n"})
+        self.git("init", "-q")
+        self.git("add", ".")
+        self.git("-c", "user.name=test", "-c", "user.email=test@example.com", "commit", "-q", "-m", "first")
+        # the working tree is not the revision anymore
+        write_tree(self.root, {"main.py": "import flask\n", "pkg/helper.py": "import toml\n", "new.py": "import attr\n"})
+        old_cwd = os.getcwd()
+        os.chdir(self.root)
+        self.addCleanup(os.chdir, old_cwd)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def git(self, *arguments):
+        subprocess.run(["git", "-C", self.root, *arguments], check=True, capture_output=True)
+
+    def test_revision(self):
+        status, lines = run_output(fpd.run, findpydeps.parser, ["--git-rev", "HEAD", "-i", ".", "--no-header"])
+        self.assertEqual(status, 0)
+        self.assertEqual(lines, ["requests", "yaml"])
+        # the git cat-file process is stopped, and the filesystem is scanned again
+        self.assertIsNone(fpd.GIT_CAT_FILE)
+        self.assertIsNone(fpd.GIT_FILES)
+
+    def test_compare_revisions(self):
+        with open("main.py", "w") as f:
+            f.write("import requests\nimport click\n")
+        self.git("-c", "user.name=test", "-c", "user.email=test@example.com", "commit", "-q", "-am", "second")
+        status, lines = run_output(
+            fpd.run, findpydeps.parser, ["--git-rev", "HEAD~", "--git-rev", "HEAD", "-i", ".", "--no-header"]
+        )
+        self.assertEqual(status, 0)
+        self.assertEqual(lines, ["+click", "+toml", "-yaml"])
+
+
+MARKER_ENVIRONMENT = {
+    "python_version": "3.10",
+    "python_full_version": "3.10.4",
+    "sys_platform": "linux",
+    "os_name": "posix",
+    "platform_machine": "x86_64",
+    "implementation_name": "cpython",
+}
+
+MARKER_CASES = [
+    ('python_version >= "3.8"', "", True),
+    # compared as versions, not as strings
+    ('python_version < "3.9"', "", False),
+    ('"3.10" == python_version', "", True),
+    ('python_version == "3.10.0"', "", True),
+    ('python_full_version ~= "3.10.0"', "", True),
+    ('python_full_version ~= "3.9.0"', "", False),
+    ('python_version ~= "3.8"', "", True),
+    ("platform_machine == 'x86_64'", "", True),
+    ('sys_platform == "win32"', "", False),
+    ('"linux" in sys_platform', "", True),
+    ('sys_platform not in "win32 cygwin"', "", True),
+    ('os_name == "nt" or platform_machine == "x86_64"', "", True),
+    ('os_name == "posix" and (sys_platform == "darwin" or implementation_name == "cpython")', "", True),
+    # "and" binds tighter than "or"
+    ('implementation_name == "pypy" or os_name == "posix" and sys_platform == "darwin"', "", False),
+    ('os_name == "posix" and sys_platform == "darwin" or implementation_name == "cpython"', "", True),
+    ('extra == "test"', "", False),
+    ('extra == "test"', "test", True),
+    # extras are normalized names
+    ('extra == "Test_Docs"', "test-docs", True),
+    ('python_version >= "3" and extra == "test"', "docs", False),
+    # malformed markers are false
+    ("python_version <", "", False),
+    ('python_version ?? "3"', "", False),
+]
+
+FAKE_DISTRIBUTIONS = {
+    "web-app": {"name": "Web_App", "version": "1.0", "top_level": ["webapp"], "requires": [
+        "Requests>=2", "pytest; extra == 'test'", "colorama; sys_platform == 'nonexistent'", "Celery[redis]>=5",
+    ]},
+    "requests": {"name": "requests", "version": "2.0", "top_level": ["requests"], "requires": [
+        "urllib3", 'PySocks!=1.5.7; extra == "socks"',
+    ]},
+    "celery": {"name": "celery", "version": "5.0", "top_level": ["celery"], "requires": [
+        "kombu", "redis>=4; extra == 'redis'", "PyYAML; extra == 'yaml'",
+    ]},
+}
+FAKE_DISTRIBUTIONS.update(
+    (name, {"name": name, "version": "1.0", "top_level": [name], "requires": []})
+    for name in ("urllib3", "pytest", "pysocks", "colorama", "kombu", "redis", "pyyaml")
+)
+
+
+class TransitiveTestCase(unittest.TestCase):
+    def test_markers(self):
+        for marker, extra, expected in MARKER_CASES:
+            with self.subTest(marker=marker, extra=extra):
+                self.assertIs(fpd.evaluate_marker(marker, {**MARKER_ENVIRONMENT, "extra": extra}), expected)
+
+    def test_extras(self):
+        with mock.patch.object(fpd, "installed_distributions", return_value=FAKE_DISTRIBUTIONS):
+            self.assertEqual(
+                fpd.transitive_dependencies(["webapp.views", "not_installed"]),
+                {"Web_App", "requests", "urllib3", "celery", "kombu", "redis", "not_installed"},
+            )
+
+
+class ImportCostTestCase(unittest.TestCase):
+    def test_measure(self):
+        cost = fpd.measure_import_cost("json")
+        self.assertIsNotNone(cost)
+        self.assertGreater(cost[1], 0)
+        # already imported when the interpreter starts
+        self.assertEqual(fpd.measure_import_cost("sys"), (0, 0))
+        self.assertIsNone(fpd.measure_import_cost("not_a_module_at_all"))
+
+    def test_invalid_module_names_are_not_run(self):
+        with mock.patch.object(fpd.subprocess, "run") as run:
+            for module_name in ("os;import pathlib;pathlib.Path('x').touch()", "a b", "os.", "1abc", ""):
+                with self.subTest(module_name=module_name):
+                    self.assertIsNone(fpd.measure_import_cost(module_name))
+        run.assert_not_called()
+
+
+LAZY_SOURCE = """import deco_mod
+import default_mod
+import annotation_mod
+import lambda_mod
+import method_mod
+import both_mod
+import unused_mod
+from pkg import thing
+from typing import Optional
+
+
+@deco_mod.register
+def function(x=default_mod.VALUE, y: annotation_mod.Type = None) -> Optional[int]:
+    return both_mod.run()
+
+
+callback = lambda: lambda_mod.call()
+
+
+class Class:
+    attribute = Optional
+
+    def method(self):
+        return method_mod.call(), thing
+
+
+both_mod.init()
+"""
+
+
+class AuditLazyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.root = self.tmp_dir.name
+        write_tree(self.root, {"module.py": LAZY_SOURCE})
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def scan(self, *options):
+        status, lines = run_output(fpd.run, findpydeps.parser, ["-i", self.root, "--no-header", *options])
+        self.assertEqual(status, 0)
+        dependencies = [line for line in lines if not line.startswith("#")]
+        candidates = set(
+            match.groups() for match in map(
+                re.compile(r"# .*module\.py:(\d+): (\S+) \((\w+)\) is only used inside functions").fullmatch, lines
+            ) if match
+        )
+        return dependencies, candidates
+
+    def test_candidates(self):
+        # module level: decorators, default values, annotations, class bodies
+        _, candidates = self.scan("--audit-lazy")
+        self.assertEqual(
+            candidates, {("4", "lambda_mod", "lambda_mod"), ("5", "method_mod", "method_mod"), ("8", "pkg.thing", "thing")}
+        )
+
+    def test_same_report_without_functions_and_blocks(self):
+        self.assertEqual(self.scan("--audit-lazy", "--no-functions", "--no-blocks")[1], self.scan("--audit-lazy")[1])
+
+    def test_same_dependencies(self):
+        for options in ([], ["--no-functions"], ["-r", "3"]):
+            with self.subTest(options=options):
+                self.assertEqual(self.scan("--audit-lazy", *options)[0], self.scan(*options)[0])
+
+
+ROLLUP_TREE = {
+    "a/a_mod.py": "import requests\nfrom ..c import b_mod\n",
+    "c/b_mod.py": "import yaml\nfrom ..a import a_mod\n",
+    "c/sub/deep.py": "import toml\n",
+}
+
+
+class RollupTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.root = self.tmp_dir.name
+        write_tree(self.root, ROLLUP_TREE)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def rollup(self, inputs, *options):
+        status, lines = run_output(fpd.run, findpydeps.parser, [
+            "-i", *(os.path.join(self.root, path) for path in inputs), "--no-header", "--no-progress", *options,
+        ])
+        self.assertEqual(status, 0)
+        dependencies = dict()
+        for line in lines:
+            if line.startswith("# "):
+                dir_dependencies = dependencies[os.path.relpath(os.path.abspath(line[2:]), self.root)] = set()
+            else:
+                dir_dependencies.add(line)
+        return dependencies
+
+    def test_depth(self):
+        self.assertEqual(self.rollup(["."], "--rollup", "1"), {
+            ".": {"requests", "yaml", "toml"}, "a": {"requests"}, "c": {"yaml", "toml"},
+        })
+        self.assertEqual(self.rollup(["."], "--rollup", "2")[os.path.join("c", "sub")], {"toml"})
+
+    def test_import_cycle(self):
+        # the files of the cycle are parsed once, whatever the order of the inputs
+        for inputs in (["a", "c"], ["c", "a"]):
+            with self.subTest(inputs=inputs):
+                self.assertEqual(self.rollup(inputs, "-l", "--rollup", "0"), {
+                    "a": {"requests", "yaml"}, "c": {"requests", "yaml", "toml"},
+                })
+        _, lines = run_output(fpd.run, findpydeps.parser, ["-i", os.path.join(self.root, "c"), "-l", "--no-header"])
+        self.assertEqual(set(lines), {"requests", "yaml", "toml"})
+
+
+CONTAINS_TREE = {
+    "first.py": "import os\n",
+    "second.py": "import pickle\n",
+    "third.py": "from xml.etree import ElementTree\n",
+    "fourth.py": "import pickle\nimport telnetlib\n",
+}
+
+
+class ContainsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.root = self.tmp_dir.name
+        write_tree(self.root, CONTAINS_TREE)
+        self.files = [os.path.join(self.root, path) for path in CONTAINS_TREE]
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def contains(self, *options):
+        with mock.patch.object(fpd, "parse_python_file", wraps=fpd.parse_python_file) as parse_python_file:
+            status, lines = run_output(fpd.run, findpydeps.parser, ["-i", *self.files, "--no-progress", *options])
+        parsed_files = [os.path.basename(call.args[0]) for call in parse_python_file.call_args_list]
+        return status, lines, parsed_files
+
+    def found(self, file_name, name):
+        return f"{os.path.relpath(os.path.join(self.root, file_name))}: {name}"
+
+    def test_stops_at_first_match(self):
+        status, lines, parsed_files = self.contains("--contains", "pickle,telnetlib")
+        self.assertEqual(status, 0)
+        self.assertEqual(lines, [self.found("second.py", "pickle")])
+        self.assertEqual(parsed_files, ["first.py", "second.py"])
+
+    def test_contains_all(self):
+        status, lines, parsed_files = self.contains("--contains", "pickle,telnetlib", "--contains-all")
+        self.assertEqual(status, 0)
+        self.assertEqual(lines, [self.found("second.py", "pickle"), self.found("fourth.py", "telnetlib")])
+        self.assertEqual(parsed_files, ["first.py", "second.py", "third.py", "fourth.py"])
+
+    def test_submodule(self):
+        status, lines, _ = self.contains("--contains", "xml")
+        self.assertEqual(status, 0)
+        self.assertEqual(lines, [self.found("third.py", "xml")])
+
+    def test_not_found(self):
+        status, lines, parsed_files = self.contains("--contains", "marshal")
+        self.assertEqual(status, 1)
+        self.assertEqual(lines, [])
+        self.assertEqual(len(parsed_files), len(CONTAINS_TREE))
+        # with --contains-all, all the modules must be found
+        status, _, _ = self.contains("--contains", "pickle,marshal", "--contains-all")
+        self.assertEqual(status, 1)
+
+
+INDEX_TREE = {
+    "main.py": "import helper\nimport requests.adapters\n",
+    "my_pkg/a.py": "import alpha\nimport a_b\n",
+    "myXpkg/b.py": "import beta\nimport aXb\n",
+}
+
+
+class IndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.root = self.tmp_dir.name
+        self.db_path = os.path.join(self.root, "index.db")
+        write_tree(self.root, INDEX_TREE)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def index(self, *arguments):
+        status, lines = run_output(fpd.run_index, fpd.index_parser, ["--db", self.db_path, *arguments])
+        self.assertEqual(status, 0)
+        return lines
+
+    def update(self):
+        # "# path: N files, M (re-)indexed, K removed"
+        return tuple(map(int, re.findall(r"(\d+) (?:files|\(re-\)indexed|removed)", self.index("-i", self.root)[0])))
+
+    def deps(self, path):
+        return set(self.index("deps", os.path.join(self.root, path)))
+
+    def who_imports(self, module):
+        return set(os.path.relpath(path, self.root) for path in map(os.path.abspath, self.index("who-imports", module)))
+
+    def test_incremental_update(self):
+        self.assertEqual(self.update(), (3, 3, 0))
+        self.assertEqual(self.update(), (3, 0, 0))
+        with open(os.path.join(self.root, "main.py"), "a") as f:
+            f.write("import yaml\n")
+        self.assertEqual(self.update(), (3, 1, 0))
+        self.assertIn("yaml", self.deps("."))
+
+    def test_removed_file(self):
+        self.update()
+        os.remove(os.path.join(self.root, "myXpkg", "b.py"))
+        self.assertEqual(self.update(), (2, 0, 1))
+        self.assertEqual(self.who_imports("beta"), set())
+
+    def test_who_imports(self):
+        self.update()
+        self.assertEqual(self.who_imports("requests"), {"main.py"})
+        # "_" is not a wildcard, and the case matters
+        self.assertEqual(self.who_imports("a_b"), {os.path.join("my_pkg", "a.py")})
+        self.assertEqual(self.who_imports("AXB"), set())
+
+    def test_deps(self):
+        self.update()
+        self.assertEqual(self.deps("my_pkg"), {"alpha", "a_b"})
+        self.assertEqual(self.deps("."), {"helper", "requests", "alpha", "a_b", "beta", "aXb"})
+
+    def test_local_module_added_and_removed(self):
+        self.update()
+        self.assertIn("helper", self.deps("."))
+        helper_path = os.path.join(self.root, "helper.py")
+        with open(helper_path, "w") as f:
+            f.write("import yaml\n")
+        self.update()
+        _, expected = run_output(fpd.run, findpydeps.parser, ["-i", self.root, "--no-header", "--no-progress"])
+        self.assertEqual(self.deps("."), set(expected))
+        self.assertNotIn("helper", self.deps("."))
+        os.remove(helper_path)
+        self.update()
+        self.assertIn("helper", self.deps("."))
+        self.assertNotIn("yaml", self.deps("."))
+
+
 if __name__ == '__main__':
     unittest.main()